@@ -0,0 +1,97 @@
+"""
+Load benchmark for the export endpoints.
+
+Runs N concurrent exports against a running app while probing the cheap
+/translations/ endpoint, and prints the latency percentiles of both. Run it
+against the app before and after a change to compare them, e.g.:
+
+    python -m benchmarks.export_load --url http://localhost:8000 --vendor vivense --concurrency 8 --limit 5000
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def timed_get(session, url, params=None):
+    # time to the last byte of the response body
+    start = time.perf_counter()
+    with session.get(url, params=params, stream=True) as r:
+        r.raise_for_status()
+        for _ in r.iter_content(64 * 1024):
+            pass
+    return time.perf_counter() - start
+
+
+def run_exports(url, params, requests_count, results):
+    session = requests.Session()
+    for _ in range(requests_count):
+        results.append(timed_get(session, url, params))
+
+
+def run_probes(url, stop, results, interval=0.05):
+    session = requests.Session()
+    while not stop.is_set():
+        results.append(timed_get(session, url, {'per_page': 25}))
+        time.sleep(interval)
+
+
+def report(name, values):
+    if not values:
+        print(f'{name:<14} no requests')
+        return
+    print(f'{name:<14} n={len(values):<5} p50={percentile(values, 50) * 1000:8.1f}ms '
+          f'p95={percentile(values, 95) * 1000:8.1f}ms p99={percentile(values, 99) * 1000:8.1f}ms '
+          f'mean={statistics.mean(values) * 1000:8.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent export load benchmark')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--vendor', default='vivense')
+    parser.add_argument('--lang', help='benchmark the translated export of this language')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent exports')
+    parser.add_argument('--requests', type=int, default=5, help='exports per concurrent client')
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.lang:
+        export_url = f'{args.url}/{args.vendor}/translated/export'
+        params = {'lang': args.lang, 'limit': args.limit}
+    else:
+        export_url = f'{args.url}/{args.vendor}/export'
+        params = {'limit': args.limit}
+
+    exports, probes = [], []
+    stop = threading.Event()
+    probe = threading.Thread(target=run_probes, args=(f'{args.url}/translations/', stop, probes))
+    probe.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_exports, export_url, params, args.requests, exports)
+                   for _ in range(args.concurrency)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    probe.join()
+
+    print(f'=> {args.concurrency} concurrent exports of {args.limit} products in {elapsed:.1f}s')
+    report('export', exports)
+    report('/translations/', probes)
+
+
+if __name__ == '__main__':
+    main()
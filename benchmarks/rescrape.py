@@ -0,0 +1,98 @@
+"""
+Re-scrape check for the delta exports.
+
+An unchanged product scraped again must keep its content hash, or its
+updated_at moves and every since= export returns it. Parses a sample Koctas
+product in processes with different hash seeds and compares the content
+hashes, then writes the sample twice to a scratch vendor and checks its
+updated_at did not move, e.g.:
+
+    python -m benchmarks.rescrape
+    python -m benchmarks.rescrape --no-db
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+
+KOCTAS_SAMPLE = {
+    'code': '5000123',
+    'brandName': 'Bosch',
+    'name': 'Darbeli Matkap 710 W',
+    'categories': [{'name': 'Elektrikli El Aletleri'}, {'name': 'Matkaplar'}],
+    'price': {'value': 1899.0, 'currencyIso': 'TRY'},
+    'priceWithDiscount': {'value': 1599.0},
+    'classifications': [{'features': [{'name': 'Motor Gücü', 'featureValues': [{'value': '710 W'}]}]}],
+    'baseOptions': [],
+    'description': '<p>Darbeli matkap &amp; vidalama fonksiyonu</p>',
+    'summary': '',
+    'images': [{'format': 'zoom', 'url': f'/medias/{i}.jpg'} for i in range(8)] +
+              [{'format': 'thumbnail', 'url': '/medias/0.jpg'}, {'format': 'zoom', 'url': '/medias/3.jpg'}],
+}
+
+
+def parse_sample():
+    # KoctasScraper.parse_product_data only reads the vendor category, no session or vendor lookup needed
+    from core.scraper.koctas import KoctasScraper
+    scraper = SimpleNamespace(vendor=SimpleNamespace(category='Ev ve Bahçe / Mobilya'))
+    return KoctasScraper.parse_product_data(scraper, KOCTAS_SAMPLE)
+
+
+def print_content_hash():
+    from core.models import content_hash
+    print(content_hash(parse_sample()))
+
+
+def check_hash_seeds(seeds):
+    hashes = set()
+    for seed in seeds:
+        env = dict(os.environ, PYTHONHASHSEED=str(seed))
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.rescrape', '--print-hash'], env=env,
+                                capture_output=True, text=True, check=True).stdout
+        hashes.add(output.strip().splitlines()[-1])
+    print(f'=> content hashes over {len(seeds)} hash seeds: {len(hashes)} distinct')
+    return len(hashes) == 1
+
+
+def check_updated_at():
+    from core.models import Vendor
+    from core.db import products_collection, vendors_collection
+    vendor = Vendor.find_by_name('rescrape-check')
+    if not vendor:
+        vendor = Vendor('rescrape-check')
+        vendor.save()
+    try:
+        vendor.bulk_create_products([parse_sample()])
+        before = products_collection.find_one({'vendor_id': vendor.id})['updated_at']
+        time.sleep(0.01)
+        vendor.bulk_create_products([parse_sample()])
+        after = products_collection.find_one({'vendor_id': vendor.id})['updated_at']
+    finally:
+        vendor.delete_all_products()
+        vendors_collection.delete_one({'_id': vendor.id})
+    print(f'=> updated_at after an unchanged re-scrape: {"kept" if before == after else "moved"}')
+    return before == after
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-scrape content hash check')
+    parser.add_argument('--seeds', type=int, default=4, help='number of hash seeds to parse the sample with')
+    parser.add_argument('--no-db', action='store_true', help='skip the updated_at check against the database')
+    parser.add_argument('--print-hash', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.print_hash:
+        print_content_hash()
+        return
+    ok = check_hash_seeds(range(args.seeds))
+    if not args.no_db:
+        ok = check_updated_at() and ok
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
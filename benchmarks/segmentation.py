@@ -0,0 +1,139 @@
+"""
+Segmentation benchmark for the product descriptions.
+
+Compares the BeautifulSoup path translate_product used (html.parser, walk the
+text nodes, replace_with, serialize) with core.Translation.segments
+(extract_segments + merge_segments), on one core and on a process pool,
+checks both find the same segments and that merging the segments back gives
+the description again. Descriptions are read from the products
+of a vendor, or from the embedded Vivense and Koctas samples, e.g.:
+
+    python -m benchmarks.segmentation --vendor vivense --limit 5000 --processes 4
+    python -m benchmarks.segmentation --copies 2000
+"""
+import argparse
+import html
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, NavigableString
+from core.Translation.segments import extract_segments, merge_segments
+
+
+VIVENSE_SAMPLE = """<div class="panel-body" style="display: block;">
+                                        <table class="table">
+                                            <tbody id="producttables" class="desctab">
+                                                <tr><th>Kumaş Rengi:</th><td>KİREMİT</td></tr>
+<tr><th>Takım İçeriği</th><td>Sağ köşe orta modül sol köşe ve puf modülünden oluşmaktadır.</td></tr>
+<tr><th>Kumaş İçeriği</th><td>Keten kumaş kullanılmıştır.</td></tr>
+<tr><th>Kumaş Özelliği</th><td>Silinebilir kumaştır.</td></tr>
+<tr><th>Fonksiyon</th><td>Modüler</td></tr>
+<tr><th>İskelet Malzemesi</th><td>Kavak kontrplak ve keresteden üretilmiştir.</td></tr>
+<tr><th>Oturum Yumuşaklığı</th><td>Yumuşak</td></tr>
+<tr><th>Oturum Minderi Malzemesi</th><td>32 DNS reflex ve kuş tüyü malzeme kullanılmıştır.</td></tr>
+<tr><th>Sırt Minderi Malzemesi</th><td>Minderi yoktur.</td></tr>
+<tr><th>Ayak Malzemesi</th><td>Plastik</td></tr>
+<tr><th>Kumaş Bakım/Temizlik Önerisi</th><td>Nemli bezle silinebilir.</td></tr>
+<tr><th>Demonte Parçalar</th><td>Tüm parçalar demonte gönderilir.</td></tr>
+<tr><th>Renk</th><td>Kiremit</td></tr>
+<tr><th>Ek Bilgiler</th><td>6 adet kırlent hediyemizdir. Renkli kırlentler fiyata dahil değildir. Ürün altında bulunan kilit mekanizması ile modülleri birbirine kolaylıkla sabitleyebilirsiniz. Ölçüler Dıştan dışa Genişlik: 296cm Derinlik: 107cm Sırt yüksekliği: 68cm Oturum yüksekliği: 43cm</td></tr>
+                                            </tbody>
+                                        </table>
+                                    </div><br>
+                <div class="panel panel-default custom-panel" id="part87">
+                    <div class="panel-heading pd-productsize open">Ürün Boyutları</div>
+                    <div class="panel-body nopadding" style="display: block;">
+                        <table class="table product-feature">
+                            <thead><tr><th class="main-header">&nbsp;</th><th>Genişlik</th><th>Derinlik</th><th>Yükseklik</th></tr></thead>
+                            <tbody>
+                                <tr><th>Köşe Koltuk</th><td>300.0 cm</td><td>68.0 cm</td><td>107.0 cm</td></tr>
+                            </tbody>
+                        </table>
+                    </div>
+                </div>
+                """
+
+KOCTAS_SAMPLE = """<p><strong>Ürün Özellikleri</strong></p>
+<ul>
+<li>Darbeli matkap &amp; vidalama fonksiyonu</li>
+<li>Motor gücü: 710 W</li>
+<li>Boşta devir sayısı: 0-3000 dev/dak</li>
+<li>Maksimum delme çapı (beton): 13 mm</li>
+<li>Anahtarlı mandren, 1,5 - 13 mm</li>
+</ul>
+<p>Sağ/sol dönüş özelliği sayesinde vidalama ve sökme işlemlerinde kolaylık sağlar.<br />&nbsp;Ergonomik tutma yeri ile uzun süreli kullanımda yorulmayı azaltır.</p>
+<!-- stok bilgisi -->
+<p><em>Kutu içeriği:</em> 1 adet darbeli matkap, 1 adet yan tutamak, 1 adet derinlik mastarı</p>
+<script type="text/javascript">var productCode = "5000123";</script>"""
+
+
+def bs4_path(description):
+    # the former translate_product parsing, with the texts "translated" to upper case; comments and
+    # the other special strings bs4 returns as text nodes are skipped, as extract_segments keeps them as markup
+    soup = BeautifulSoup(description, 'html.parser')
+    tags = [tag for tag in soup.descendants if type(tag) is NavigableString and tag.strip() and tag.parent.name not in ['script', 'style']]
+    segments = [tag.string.strip() for tag in tags]
+    for tag, text in zip(tags, segments):
+        tag.replace_with(text.upper())
+    return segments, str(soup).replace('\n', '')
+
+
+def segments_path(description):
+    segments, skeleton = extract_segments(description)
+    return segments, merge_segments(skeleton, [text.upper() for text in segments]).replace('\n', '')
+
+
+def load_descriptions(vendor_name, limit):
+    from core.models import Vendor
+    vendor = Vendor.find_by_name(vendor_name)
+    if not vendor:
+        raise SystemExit(f"Unsupported vendor '{vendor_name}'")
+    return [product['description'] for product in vendor.get_products(limit=limit) if product.get('description')]
+
+
+def run(name, path, descriptions, processes=None):
+    start = time.perf_counter()
+    if processes:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(path, descriptions, chunksize=64))
+    else:
+        results = [path(description) for description in descriptions]
+    elapsed = time.perf_counter() - start
+    mode = f'{processes} processes' if processes else '1 core'
+    print(f'{name:<10} {mode:<12} {elapsed:8.2f}s {len(descriptions) / elapsed:10.0f} descriptions/s')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Description segmentation benchmark')
+    parser.add_argument('--vendor', help='read the descriptions of this vendor products instead of the samples')
+    parser.add_argument('--limit', type=int, default=5000)
+    parser.add_argument('--copies', type=int, default=1000, help='copies of each embedded sample')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.vendor:
+        descriptions = load_descriptions(args.vendor, args.limit)
+    else:
+        descriptions = [VIVENSE_SAMPLE, KOCTAS_SAMPLE] * args.copies
+    print(f'=> {len(descriptions)} descriptions, {sum(map(len, descriptions)) / 1024 / 1024:.1f} MB')
+
+    bs4_results = run('bs4', bs4_path, descriptions)
+    segments_results = run('segments', segments_path, descriptions)
+    if args.processes > 1:
+        run('bs4', bs4_path, descriptions, args.processes)
+        run('segments', segments_path, descriptions, args.processes)
+
+    # both paths should find the same texts, any mismatch is a real divergence;
+    # the markup itself may differ as bs4 normalizes it
+    mismatches = sum(a[0] != b[0] for a, b in zip(bs4_results, segments_results))
+    print(f'=> segment mismatches: {mismatches}/{len(descriptions)}')
+
+    # merging the untranslated segments back gives the description again, up to the entity spelling
+    roundtrip = sum(html.unescape(merge_segments(*reversed(extract_segments(description)))) != html.unescape(description)
+                    for description in descriptions)
+    print(f'=> round trip mismatches: {roundtrip}/{len(descriptions)}')
+
+
+if __name__ == '__main__':
+    main()
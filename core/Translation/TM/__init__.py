@@ -1,24 +1,304 @@
-from core.db import db
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict
+from pymongo import UpdateOne, UpdateMany, errors
+from core.db import db, config, translation_key, search_ngrams
+
+try:
+    import redis
+except ImportError:  # the shared cache tier is optional
+    redis = None
+
+
+# numbers of a segment, '300', '300.0', '1,5'
+NUMBER_PATTERN = re.compile(r'\d+(?:[.,]\d+)*')
+PLACEHOLDER_PATTERN = re.compile(r'\{(\d+)\}')
+
+# units of the dimensions and measurements of the descriptions
+UNITS = r'cm|mm|m|m2|m²|m3|m³|km|kg|gr|g|mg|lt|l|ml|cl|w|kw|watt|v|volt|a|mah|dns|inç|inch|°c|°'
+# the numbers masked: decimals, and numbers followed by a unit ('296cm', '13 mm'); counts ('3 adet')
+# and codes ('X200') are left in the text, their translation depends on them (plural forms)
+MEASUREMENT_PATTERN = re.compile(
+    r'(?<!\w)(?<!\d[.,])(?:\d+(?:[.,]\d+)+|\d+(?=\s?(?:' + UNITS + r')(?![^\W\d_])))',
+    re.IGNORECASE
+)
+
+
+def mask_numbers(text):
+    # 'Genişlik: 296cm Derinlik: 107cm' -> ('Genişlik: {0}cm Derinlik: {1}cm', ['296', '107']),
+    # texts with braces, a repeated measurement or a count equal to one are left as they are
+    numbers = MEASUREMENT_PATTERN.findall(text)
+    if not numbers or '{' in text or '}' in text or len(set(numbers)) != len(numbers):
+        return text, []
+    all_numbers = NUMBER_PATTERN.findall(text)
+    if any(all_numbers.count(number) > 1 for number in numbers):
+        return text, []
+    counter = itertools.count()
+    return MEASUREMENT_PATTERN.sub(lambda m: f'{{{next(counter)}}}', text), numbers
+
+
+def mask_translation(translation, numbers):
+    # template of the translation of a masked text, None when the masked numbers did not come through unchanged;
+    # the other numbers of the translation stay as they are
+    found = NUMBER_PATTERN.findall(translation)
+    if '{' in translation or '}' in translation or any(found.count(number) != 1 for number in numbers):
+        return None
+    index = {number: i for i, number in enumerate(numbers)}
+    return NUMBER_PATTERN.sub(lambda m: f'{{{index[m.group()]}}}' if m.group() in index else m.group(), translation)
+
+
+def unmask_numbers(template, numbers):
+    return PLACEHOLDER_PATTERN.sub(
+        lambda m: numbers[int(m.group(1))] if int(m.group(1)) < len(numbers) else m.group(), template
+    )
+
+
+class LRUCache:
+    # bounded in-process cache, entries expire after ttl seconds so edits made by other processes show up
+    def __init__(self, maxsize=100000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item and item[1] > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item:
+                del self.data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+
+class TranslationCache:
+    # in-process LRU in front of an optional redis tier shared by the app and the workers;
+    # an unreachable redis fails fast and is skipped for redis_retry seconds, the lookups fall back to mongo
+    def __init__(self, maxsize=100000, ttl=300, redis_url=None, redis_ttl=7 * 24 * 3600, redis_timeout=0.5,
+                 redis_retry=30):
+        self.local = LRUCache(maxsize, ttl)
+        self.redis = redis.Redis.from_url(redis_url, socket_connect_timeout=redis_timeout,
+                                          socket_timeout=redis_timeout) if redis and redis_url else None
+        self.redis_ttl = redis_ttl
+        self.redis_retry = redis_retry
+        self.redis_retry_at = 0
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def redis_available(self):
+        return self.redis is not None and time.monotonic() >= self.redis_retry_at
+
+    def redis_error(self, e):
+        print('=> TM cache error:', e)
+        self.redis_retry_at = time.monotonic() + self.redis_retry
+
+    @staticmethod
+    def key(source_text, source_lang, target_lang):
+        return f'tm:{translation_key(source_text, source_lang, target_lang).hex()}'
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.redis_available():
+            try:
+                value = self.redis.get(key)
+            except redis.RedisError as e:
+                self.redis_error(e)
+                return None
+            if value is None:
+                self.redis_misses += 1
+                return None
+            self.redis_hits += 1
+            value = value.decode('utf-8')
+            self.local.set(key, value)
+        return value
+
+    def get_many(self, keys):
+        # values of the cached keys, the local misses are read from redis in one round trip
+        values = {}
+        for key in keys:
+            if (value := self.local.get(key)) is not None:
+                values[key] = value
+        missing = [key for key in keys if key not in values]
+        if missing and self.redis_available():
+            try:
+                redis_values = self.redis.mget(missing)
+            except redis.RedisError as e:
+                self.redis_error(e)
+                return values
+            for key, value in zip(missing, redis_values):
+                if value is None:
+                    self.redis_misses += 1
+                    continue
+                self.redis_hits += 1
+                values[key] = value.decode('utf-8')
+                self.local.set(key, values[key])
+        return values
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.local.set(key, value)
+        if items and self.redis_available():
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                for key, value in items.items():
+                    pipeline.set(key, value, ex=self.redis_ttl)
+                pipeline.execute()
+            except redis.RedisError as e:
+                self.redis_error(e)
+
+    def delete(self, key):
+        self.local.delete(key)
+        # always tried, a skipped invalidation would leave the old translation in redis
+        if self.redis:
+            try:
+                self.redis.delete(key)
+            except redis.RedisError as e:
+                self.redis_error(e)
+
+    def info(self):
+        return dict(self.local.info(), redis_hits=self.redis_hits, redis_misses=self.redis_misses)
+
+
+cache = TranslationCache(
+    maxsize=int(config.get('TM_CACHE_SIZE', 100000)),
+    ttl=int(config.get('TM_CACHE_TTL', 300)),
+    redis_url=config.get('REDIS_URI'),
+    redis_timeout=float(config.get('TM_REDIS_TIMEOUT', 0.5)),
+)
 
 
 class TM:
 
     def __init__(self):
         self.collection = db['translation_memory']
+        self.cache = cache
 
     def get_translation(self, source_text, source_lang, target_lang):
-        document = self.collection.find_one({'source_text': source_text, 'source_lang': source_lang, 'target_lang': target_lang})
+        key = self.cache.key(source_text, source_lang, target_lang)
+        target_text = self.cache.get(key)
+        if target_text is not None:
+            return target_text
+        document = self.collection.find_one({'key': translation_key(source_text, source_lang, target_lang)})
+        if document:
+            self.cache.set(key, document['target_text'])
         return document['target_text'] if document else None
 
     def save_translation(self, source_text, source_lang, target_text, target_lang):
         if source_text and target_text:
             document = {
+                'key': translation_key(source_text, source_lang, target_lang),
                 'source_text': source_text,
                 'source_lang': source_lang,
                 'target_text': target_text,
-                'target_lang': target_lang
+                'target_lang': target_lang,
+                'search_ngrams': search_ngrams(source_text, target_text)
             }
             result = self.collection.insert_one(document)
+            self.cache.set(self.cache.key(source_text, source_lang, target_lang), target_text)
+
+    def get_translations(self, texts, source_lang, target_lang):
+        # {source_text: target_text} of the texts found in the TM, with one query for the cache misses
+        return self.get_translations_multi(texts, source_lang, [target_lang])[target_lang]
+
+    def get_translations_multi(self, texts, source_lang, target_langs):
+        # {target_lang: {source_text: target_text}} of the texts found in the TM for all the target languages
+        keys = {}
+        for target_lang in target_langs:
+            for text in set(texts):
+                keys.setdefault(translation_key(text, source_lang, target_lang), (target_lang, []))[1].append(text)
+        cached = self.cache.get_many([f'tm:{key.hex()}' for key in keys])
+        translations, missing = {target_lang: {} for target_lang in target_langs}, []
+        for key, (target_lang, key_texts) in keys.items():
+            target_text = cached.get(f'tm:{key.hex()}')
+            if target_text is None:
+                missing.append(key)
+                continue
+            translations[target_lang].update(dict.fromkeys(key_texts, target_text))
+        if missing:
+            documents = self.collection.find({'key': {'$in': missing}}, {'key': 1, 'target_text': 1})
+            found = {document['key']: document['target_text'] for document in documents}
+            self.cache.set_many({f'tm:{key.hex()}': target_text for key, target_text in found.items()})
+            for key, target_text in found.items():
+                target_lang, key_texts = keys[key]
+                translations[target_lang].update(dict.fromkeys(key_texts, target_text))
+        return translations
+
+    def save_translations(self, pairs, source_lang, target_lang):
+        # unordered bulk upsert of (source_text, target_text) pairs,
+        # entries already in the TM (e.g. edited by a linguist) are left as they are
+        self.save_translations_multi({target_lang: pairs}, source_lang)
+
+    def save_translations_multi(self, translations, source_lang):
+        # {target_lang: (source_text, target_text) pairs} of several languages in one bulk write
+        entries = [(source_text, target_text, target_lang)
+                   for target_lang, pairs in translations.items()
+                   for source_text, target_text in pairs if source_text and target_text]
+        if not entries:
+            return
+        ops = [
+            UpdateOne(
+                {'key': translation_key(source_text, source_lang, target_lang)},
+                {'$setOnInsert': {
+                    'source_text': source_text,
+                    'source_lang': source_lang,
+                    'target_text': target_text,
+                    'target_lang': target_lang,
+                    'search_ngrams': search_ngrams(source_text, target_text)
+                }},
+                upsert=True
+            )
+            for source_text, target_text, target_lang in entries
+        ]
+        try:
+            upserted_ids = self.collection.bulk_write(ops, ordered=False).upserted_ids
+        except errors.BulkWriteError as bwe:
+            # duplicates come from concurrent inserts of the same segment
+            if any(error['code'] != 11000 for error in bwe.details['writeErrors']):
+                raise
+            upserted_ids = {upsert['index']: upsert['_id'] for upsert in bwe.details['upserted']}
+        self.cache.set_many({self.cache.key(entries[i][0], source_lang, entries[i][2]): entries[i][1] for i in upserted_ids})
+
+    def link_products(self, segment_products, source_lang, target_langs):
+        # record the products using each segment on the TM entries serving it, masked or not, in one bulk write
+        ops = []
+        for text, product_ids in segment_products.items():
+            template = mask_numbers(text)[0]
+            for target_lang in target_langs:
+                keys = list({translation_key(text, source_lang, target_lang), translation_key(template, source_lang, target_lang)})
+                ops.append(UpdateMany({'key': {'$in': keys}}, {'$addToSet': {'products': {'$each': product_ids}}}))
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+    def invalidate(self, source_text, source_lang, target_lang):
+        # drop an edited entry from the cache tiers, the next lookup reads it from mongo
+        self.cache.delete(self.cache.key(source_text, source_lang, target_lang))
+
+    def cache_info(self):
+        return self.cache.info()
 
 
 
@@ -27,4 +307,3 @@ if __name__ == '__main__':
     # print(tm.save_translation('zaki', 'en', 'زكى', 'ar'))
     # print(tm.get_translation('zaki', 'en', 'ar'))
     db['translation_memory'].update_many({}, {"$set": {"target_lang": "ar"}})
-
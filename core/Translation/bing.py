@@ -1,15 +1,62 @@
+import os
+import re
 import requests
+import threading
 import uuid
 import json
 import traceback
-from bs4 import BeautifulSoup, NavigableString, Tag
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from core.Translation.TM import TM
-
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from core.Translation.TM import TM, mask_numbers, mask_translation, unmask_numbers
+from core.Translation.segments import extract_segments, extract_all, merge_segments
+from core.models import source_hash
+
+
+# translator API limits of a single request
+MAX_ELEMENTS = 1000
+MAX_CHARACTERS = 50000
+
+# segments without letters (numbers, punctuation) are kept as they are
+LETTER_PATTERN = re.compile(r'[^\W\d_]')
+
+
+def split_text(text, max_characters=MAX_CHARACTERS):
+    # split a text longer than a request on whitespace, a single word longer than that is cut
+    pieces, piece = [], ''
+    for word in text.split(' '):
+        while len(word) > max_characters:
+            if piece:
+                pieces.append(piece)
+                piece = ''
+            pieces.append(word[:max_characters])
+            word = word[max_characters:]
+        if piece and len(piece) + 1 + len(word) > max_characters:
+            pieces.append(piece)
+            piece = word
+        else:
+            piece = f'{piece} {word}' if piece else word
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def pack_texts(texts, max_elements=MAX_ELEMENTS, max_characters=MAX_CHARACTERS):
+    # pack consecutive texts into chunks under the element and character caps of a request
+    chunks, chunk, size = [], [], 0
+    for text in texts:
+        if chunk and (len(chunk) == max_elements or size + len(text) > max_characters):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(text)
+        size += len(text)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
 
 
 class BingTranslator:
-    def __init__(self, key, location, max_workers=10):
+    def __init__(self, key, location, max_workers=10, request_workers=8, process_workers=0):
         self.key = key
         self.endpoint = "https://api.cognitive.microsofttranslator.com"
         self.location = location
@@ -22,7 +69,79 @@ class BingTranslator:
             'X-ClientTraceId': str(uuid.uuid4())
         }
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # chunks are sent from their own pool, translate_product already runs on self.executor
+        # and waiting on the same pool could deadlock it
+        self.request_executor = ThreadPoolExecutor(max_workers=request_workers)
+        self.session = self.create_session(pool_size=max_workers + request_workers)
+        # the descriptions of a batch are segmented on a process pool, parsing is CPU bound and holds the GIL;
+        # left off in celery workers, their daemon processes cannot start children
+        self.process_executor = ProcessPoolExecutor(max_workers=process_workers) if process_workers else None
         self.TM = TM()
+        # progress counters of the batch translation mode
+        self.stats = {'products': 0, 'segments': 0, 'unique_segments': 0, 'api_calls': 0, 'tm_hits': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, **counters):
+        with self.stats_lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def stats_info(self):
+        # dedup_ratio is the share of the segments served by another product of their window
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['dedup_ratio'] = round(1 - stats['unique_segments'] / stats['segments'], 3) if stats['segments'] else 0.0
+        return stats
+
+    def create_session(self, pool_size):
+        # keep-alive connections shared by all the threads,
+        # throttled (429) and failed (5xx) requests are retried with backoff, honouring Retry-After
+        retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=False, raise_on_status=False)
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        session.headers.update(self.headers)
+        return session
+
+    def send(self, texts, from_lang, to_langs):
+        # one request translating the texts to all the target languages, {lang: [translations]}
+        body = [{'text': text} for text in texts]
+        params = {'api-version': '3.0', 'from': from_lang, 'to': to_langs}
+        response = self.session.post(self.constructed_url, params=params, json=body)
+        self.count(api_calls=1)
+        if response.status_code != 200:
+            raise ValueError(response.text)
+        translations = {to_lang: [] for to_lang in to_langs}
+        for result in response.json():
+            for translation in result['translations']:
+                translations[translation['to']].append(translation['text'])
+        return translations
+
+    def translate_batch(self, texts, from_lang, to_langs):
+        # machine translate any number of texts: long texts are split, the pieces packed into requests
+        # under the API caps, the requests sent concurrently and the results reassembled in order
+        # the character cap counts every target language of a request
+        max_characters = MAX_CHARACTERS // len(to_langs)
+        pieces, owners = [], []
+        for i, text in enumerate(texts):
+            for piece in split_text(text, max_characters):
+                pieces.append(piece)
+                owners.append(i)
+
+        chunks = pack_texts(pieces, max_characters=max_characters)
+        if len(chunks) == 1:
+            results = [self.send(chunks[0], from_lang, to_langs)]
+        else:
+            futures = [self.request_executor.submit(self.send, chunk, from_lang, to_langs) for chunk in chunks]
+            results = [future.result() for future in futures]
+
+        translations = {}
+        for to_lang in to_langs:
+            parts = [[] for _ in texts]
+            for owner, translation in zip(owners, (t for result in results for t in result[to_lang])):
+                parts[owner].append(translation)
+            translations[to_lang] = [' '.join(part) for part in parts]
+        return translations
 
     def translate(self, text, from_lang, to_lang):
         text = str(text)
@@ -33,17 +152,7 @@ class BingTranslator:
             return result
 
         # Machine Translation
-        body = [{'text': text}]
-        params = {
-            'api-version': '3.0',
-            'from': from_lang,
-            'to': to_lang   # ['en', 'ar']
-        }
-        response = requests.post(self.constructed_url, params=params, headers=self.headers, json=body)
-        if response.status_code != 200:
-            raise ValueError(response.text)
-
-        target_text = response.json()[0]['translations'][0]['text']
+        target_text = self.translate_batch([text], from_lang, [to_lang])[to_lang][0]
 
         # Save translation to TM
         try:
@@ -56,74 +165,161 @@ class BingTranslator:
     def translate_list(self, text_list, from_lang, to_lang):
         if not text_list:
             return text_list
-
-        text_list = {i: text.strip() for i, text in enumerate(text_list)}
-        memory_translations = {i: translation for i, text in text_list.items() if text and
-                               (translation := self.TM.get_translation(text, from_lang, to_lang)) is not None}
-        untranslated_indices = [i for i, text in text_list.items() if text and i not in memory_translations]
-
-        text_list.update(memory_translations)
-        if untranslated_indices:
-            untranslated_texts = [text_list[i] for i in untranslated_indices]
-            print('untranslated_texts:', untranslated_texts)
-            body = [{'text': text} for text in untranslated_texts]
-            params = {'api-version': '3.0', 'from': from_lang, 'to': to_lang}
-            response = requests.post(self.constructed_url, params=params, headers=self.headers, json=body)
-
-            if response.status_code != 200:
-                if 'too many elements' in response.text:
-                    return {}
-                raise ValueError(response.text)
-
-            api_translations = {}
-            for i, text in enumerate(untranslated_texts):
-                target_text = response.json()[i]['translations'][0]['text']
-                api_translations[untranslated_indices[i]] = target_text
-                try:
-                    self.TM.save_translation(source_text=text, source_lang=from_lang, target_text=target_text,
-                                             target_lang=to_lang)
-                except Exception as e:
-                    print("=> Failed to save translation: %s", e)
-
-            text_list.update(api_translations)
-
-        return list(text_list.values())
+        return self.translate_list_multi(text_list, from_lang, [to_lang])[to_lang]
+
+    def translate_list_multi(self, text_list, from_lang, to_langs):
+        # {lang: translated list} for all the target languages
+        text_list = [text.strip() for text in text_list]
+
+        # numbers are masked, so the segments differing only in their numbers share one TM entry
+        masked = {text: mask_numbers(text) for text in text_list if LETTER_PATTERN.search(text)}
+
+        # Translation memory, one query for the templates and the unmasked texts of all the languages
+        memory = self.TM.get_translations_multi(set(masked) | {template for template, numbers in masked.values()},
+                                                from_lang, to_langs)
+        translations = {to_lang: {} for to_lang in to_langs}
+        groups = {}
+        for text, (template, numbers) in masked.items():
+            for to_lang in to_langs:
+                if text in memory[to_lang]:
+                    translations[to_lang][text] = memory[to_lang][text]
+                elif template in memory[to_lang]:
+                    translations[to_lang][text] = unmask_numbers(memory[to_lang][template], numbers)
+            if any(text not in translations[to_lang] for to_lang in to_langs):
+                groups.setdefault(template, []).append(text)
+        self.count(tm_hits=sum(len(translations[to_lang]) for to_lang in to_langs))
+
+        if groups:
+            self.machine_translate(groups, masked, translations, from_lang, to_langs)
+
+        return {to_lang: [translations[to_lang].get(text, text) for text in text_list] for to_lang in to_langs}
+
+    def machine_translate(self, groups, masked, translations, from_lang, to_langs):
+        # one text of each template is machine translated, unmasked so the engine sees the real numbers,
+        # and the numbers of its translation are masked again to serve the other texts of the template
+        texts = [group[0] for group in groups.values()]
+        print('untranslated_texts:', texts)
+        results = self.translate_batch(texts, from_lang, to_langs)
+
+        entries, retry = {to_lang: [] for to_lang in to_langs}, []
+        for i, (template, group) in enumerate(groups.items()):
+            numbers = masked[group[0]][1]
+            for to_lang in to_langs:
+                missing = [text for text in group if text not in translations[to_lang]]
+                if not missing:
+                    continue
+                translation = results[to_lang][i]
+                target_template = mask_translation(translation, numbers) if numbers else translation
+                if target_template is not None:
+                    entries[to_lang].append((template, target_template))
+                    for text in missing:
+                        translations[to_lang][text] = unmask_numbers(target_template, masked[text][1])
+                else:
+                    # the numbers were rewritten, the texts of the template are translated and stored unmasked
+                    translations[to_lang][group[0]] = translation
+                    entries[to_lang].append((group[0], translation))
+                    retry.extend(text for text in missing if text != group[0])
+
+        retry = list(dict.fromkeys(retry))
+        if retry:
+            results = self.translate_batch(retry, from_lang, to_langs)
+            for to_lang in to_langs:
+                for text, translation in zip(retry, results[to_lang]):
+                    if text not in translations[to_lang]:
+                        translations[to_lang][text] = translation
+                        entries[to_lang].append((text, translation))
+
+        # Save translations to TM, one bulk write
+        try:
+            self.TM.save_translations_multi(entries, source_lang=from_lang)
+        except Exception as e:
+            print("=> Failed to save translations:", e)
 
     def translate_product(self, product, to_lang: str, from_lang='tr'):
-        # print(product)
-
-        # translate name
-        translated_name = self.translate(text=product['name'], from_lang=from_lang, to_lang=to_lang)
-
-        # translate description
-        soup = BeautifulSoup(product['description'], 'html.parser')
-
-        # Find all the HTML tags with text content
-        tags = [tag for tag in soup.descendants if isinstance(tag, NavigableString) and tag.strip() and tag.parent.name not in ['script', 'style']]
-
-        # Translate the text content
-        translated_list = self.translate_list([tag.string for tag in tags], from_lang=from_lang, to_lang=to_lang)
-
-        # Replace the original text with the translated text
-        for tag, translated_text in zip(tags, translated_list):
-            tag.replace_with(translated_text)
+        product = self.translate_product_multi(product, [to_lang], from_lang=from_lang)
+        product['translation'] = product['translation'][to_lang]
+        return product
 
-        translated_description = str(soup).replace('\n', '')
+    def translate_product_multi(self, product, to_langs, from_lang='tr'):
+        # print(product)
 
-        # print('=>', translated_description)
+        # segments stored with the product, or extracted once for all the languages
+        segments, skeleton = self.get_segments(product)
 
-        product['translation'] = {
-            'name': translated_name,
-            'description': translated_description
-        }
+        # Translate the name and the segments in one batch
+        translated_lists = self.translate_list_multi([product['name']] + segments, from_lang=from_lang, to_langs=to_langs)
 
+        self.render_translations(product, skeleton, translated_lists)
         return product
 
+    def translate_products(self, products, to_langs, from_lang='tr'):
+        # batch mode: the unique segments of a window of products are translated once
+        # and the results fanned back into every product of the window
+        products = list(products)
+        parsed = self.get_all_segments(products)
+        segments = [[product['name'].strip()] + product_segments for product, (product_segments, skeleton) in zip(products, parsed)]
+
+        unique_segments = list(dict.fromkeys(text for texts in segments for text in texts if text))
+        translated_lists = self.translate_list_multi(unique_segments, from_lang=from_lang, to_langs=to_langs)
+        translations = {to_lang: dict(zip(unique_segments, translated_lists[to_lang])) for to_lang in to_langs}
+
+        for product, (product_segments, skeleton), texts in zip(products, parsed, segments):
+            product_lists = {to_lang: [translations[to_lang].get(text, text) for text in texts] for to_lang in to_langs}
+            self.render_translations(product, skeleton, product_lists)
+
+        # the TM entries of the window segments record the products using them
+        segment_products = {}
+        for product, texts in zip(products, segments):
+            for text in texts:
+                segment_products.setdefault(text, []).append(product['_id'])
+        try:
+            self.TM.link_products(segment_products, source_lang=from_lang, target_langs=to_langs)
+        except Exception as e:
+            print("=> Failed to link products:", e)
+
+        self.count(products=len(products), segments=sum(len(texts) for texts in segments),
+                   unique_segments=len(unique_segments))
+        return products
+
+    @staticmethod
+    def get_segments(product):
+        if 'segments' in product:
+            return product['segments'], product['skeleton']
+        return extract_segments(product['description'])
+
+    def get_all_segments(self, products):
+        # only the products written before segments were stored are parsed, on the process pool
+        parsed = [(product.get('segments'), product.get('skeleton')) for product in products]
+        missing = [i for i, product in enumerate(products) if 'segments' not in product]
+        for i, result in zip(missing, extract_all([products[i]['description'] for i in missing], self.process_executor)):
+            parsed[i] = result
+        return parsed
+
+    @staticmethod
+    def render_translations(product, skeleton, translated_lists):
+        # translated_lists holds the translated name followed by the translated segments, per language
+        product['translation'] = {}
+        for to_lang, translated_list in translated_lists.items():
+            translated_name, translated_list = translated_list[0], translated_list[1:]
+
+            translated_description = merge_segments(skeleton, translated_list).replace('\n', '')
+
+            # print('=>', translated_description)
+
+            # the digest of the source the translation was made from, see Vendor.get_products(stale=True),
+            # and the translated segments, so a TM edit can patch a single one of them
+            product['translation'][to_lang] = {
+                'name': translated_name,
+                'description': translated_description,
+                'source_hash': source_hash(product),
+                'segments': translated_list
+            }
+
 
 if __name__ == '__main__':
     # Example usage:
-    key = "d74339cf185c4d42896344bcbfbc61d6"
-    location = "germanywestcentral"
+    key = os.environ['BING_TRANSLATOR_KEY']
+    location = os.environ.get('BING_TRANSLATOR_LOCATION', 'germanywestcentral')
     translator = BingTranslator(key, location)
 
     product = {
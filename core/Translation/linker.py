@@ -0,0 +1,132 @@
+import argparse
+import html
+from collections import deque
+from pymongo import UpdateMany
+from core.db import db, products_collection
+from core.backfill import bulk_update
+from core.Translation.TM import mask_numbers
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, the pure python automaton is slower but equivalent
+    ahocorasick = None
+
+
+# shorter source texts would link almost every product
+MIN_LENGTH = 2
+
+
+class Automaton:
+    # pure python Aho-Corasick automaton, the subset of ahocorasick.Automaton the linker uses
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add_word(self, word, value):
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            node = child
+        self.output[node].append(value)
+
+    def make_automaton(self):
+        # breadth first, so the failure link of a node is set before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0) if node else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def iter(self, text):
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for value in self.output[node]:
+                yield i, value
+
+
+def build_automaton(texts):
+    automaton = ahocorasick.Automaton() if ahocorasick else Automaton()
+    for text in texts:
+        automaton.add_word(text, text)
+    automaton.make_automaton()
+    return automaton
+
+
+def product_text(product):
+    # lower cased name and description texts, one per line so a match never spans two of them;
+    # the masked segments match the number templates of the TM
+    segments = product.get('segments')
+    if segments is None:
+        segments = [html.unescape(product.get('description') or '')]
+    texts = [product.get('name') or ''] + segments
+    texts += [template for template, numbers in map(mask_numbers, segments) if numbers]
+    return '\n'.join(texts).lower()
+
+
+def is_word(text, start, end, pattern):
+    # a match starting or ending with a letter or digit must not be part of a longer word
+    if pattern[0].isalnum() and start > 0 and text[start - 1].isalnum():
+        return False
+    if pattern[-1].isalnum() and end < len(text) and text[end].isalnum():
+        return False
+    return True
+
+
+def find_texts(automaton, text):
+    found = set()
+    for end, pattern in automaton.iter(text):
+        start = end - len(pattern) + 1
+        if pattern not in found and is_word(text, start, end + 1, pattern):
+            found.add(pattern)
+    return found
+
+
+def link_products(incremental=False, batch_size=1000):
+    # one pass over the products links every TM entry to the products containing its source text;
+    # incremental only links the entries without products yet (new ones), against all the products
+    collection = db['translation_memory']
+    query = {'products': {'$exists': False}} if incremental else {}
+    entries = {}
+    for entry in collection.find(query, {'source_text': 1}).batch_size(batch_size):
+        text = (entry.get('source_text') or '').strip().lower()
+        if len(text) >= MIN_LENGTH:
+            entries.setdefault(text, []).append(entry['_id'])
+    print(f'=> Linking {sum(map(len, entries.values()))} TM entries ({len(entries)} texts)..')
+    if not entries:
+        return
+
+    automaton = build_automaton(entries)
+    links = {text: [] for text in entries}
+    projection = {'name': 1, 'description': 1, 'segments': 1}
+    for i, product in enumerate(products_collection.find({}, projection).batch_size(batch_size), 1):
+        for text in find_texts(automaton, product_text(product)):
+            links[text].append(product['_id'])
+        if i % 10000 == 0:
+            print(f'=> {i} products scanned')
+
+    ops = (UpdateMany({'_id': {'$in': entries[text]}}, {'$set': {'products': product_ids}})
+           for text, product_ids in links.items())
+    print(f'=> {bulk_update(collection, ops, batch_size)} TM entries updated')
+
+
+if __name__ == '__main__':
+    # usage: python -m core.Translation.linker [--incremental]
+    parser = argparse.ArgumentParser(description='Link the TM entries to the products using them')
+    parser.add_argument('--incremental', action='store_true', help='only link the entries without products')
+    args = parser.parse_args()
+    link_products(incremental=args.incremental)
@@ -0,0 +1,102 @@
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from core.db import db, products_collection, translation_key
+from core.backfill import bulk_update
+from core.Translation.TM import mask_numbers, unmask_numbers
+from core.Translation.segments import extract_segments, merge_segments
+
+
+def segment_numbers(text, key, source_lang, target_lang):
+    # numbers to restore in the entry translation when the entry serves the text, None when it does not
+    if translation_key(text, source_lang, target_lang) == key:
+        return []
+    template, numbers = mask_numbers(text.strip())
+    if numbers and translation_key(template, source_lang, target_lang) == key:
+        return numbers
+    return None
+
+
+def direct_texts(texts, source_lang, target_lang):
+    # the texts with their own TM entry, the translator prefers it over the number template
+    if not texts:
+        return set()
+    keys = {translation_key(text, source_lang, target_lang): text for text in texts}
+    entries = db['translation_memory'].find({'key': {'$in': list(keys)}}, {'key': 1})
+    return {keys[bytes(entry['key'])] for entry in entries}
+
+
+def patch_translation(product, entry, previous_target_text):
+    # the translation.<lang> fields of the product to update, only the segments served by the entry change
+    source_lang, target_lang = entry['source_lang'], entry['target_lang']
+    key = translation_key(entry['source_text'], source_lang, target_lang)
+    translation = product['translation'][target_lang]
+    prefix = f'translation.{target_lang}'
+    fields = {}
+
+    if 'segments' in product:
+        segments, skeleton = product['segments'], product['skeleton']
+    else:
+        segments, skeleton = extract_segments(product.get('description') or '')
+    name = (product.get('name') or '').strip()
+    name_numbers = segment_numbers(name, key, source_lang, target_lang)
+    matches = [(i, numbers) for i, segment in enumerate(segments)
+               if (numbers := segment_numbers(segment, key, source_lang, target_lang)) is not None]
+
+    # texts served by the entry as a number template but translated from their own entry are left alone
+    templated = [segments[i] for i, numbers in matches if numbers] + ([name] if name_numbers else [])
+    if direct := direct_texts(templated, source_lang, target_lang):
+        matches = [(i, numbers) for i, numbers in matches if not (numbers and segments[i] in direct)]
+        if name in direct and name_numbers:
+            name_numbers = None
+
+    if name_numbers is not None:
+        fields[f'{prefix}.name'] = unmask_numbers(entry['target_text'], name_numbers)
+    if not matches:
+        return fields
+
+    translated_segments = translation.get('segments')
+    if translated_segments and len(translated_segments) == len(segments):
+        translated_segments = list(translated_segments)
+        for i, numbers in matches:
+            translated_segments[i] = unmask_numbers(entry['target_text'], numbers)
+        fields[f'{prefix}.segments'] = translated_segments
+        fields[f'{prefix}.description'] = merge_segments(skeleton, translated_segments).replace('\n', '')
+    elif previous_target_text:
+        # translated before the translated segments were stored: the translated description is segmented
+        # and only the segments equal to the old translation are replaced, not the text inside other segments
+        replacements = {unmask_numbers(previous_target_text, numbers).strip(): unmask_numbers(entry['target_text'], numbers)
+                        for i, numbers in matches}
+        translated_segments, translated_skeleton = extract_segments(translation.get('description') or '')
+        patched = [replacements.get(segment, segment) for segment in translated_segments]
+        if patched != translated_segments:
+            fields[f'{prefix}.description'] = merge_segments(translated_skeleton, patched)
+    return fields
+
+
+def propagation_query(entry):
+    # the products linked to the entry and translated to its language
+    return {'_id': {'$in': [ObjectId(product_id) for product_id in entry.get('products', [])]},
+            f'translation.{entry["target_lang"]}': {'$exists': True}}
+
+
+def propagate_translation(translation_id, previous_target_text, batch_size=500):
+    # patch the stored translations of the products linked to an edited TM entry,
+    # returns the vendor ids of the patched products and their number
+    entry = db['translation_memory'].find_one({'_id': ObjectId(translation_id)})
+    if not entry or not entry.get('products'):
+        return set(), 0
+
+    target_lang = entry['target_lang']
+    query = propagation_query(entry)
+    projection = {'vendor_id': 1, 'name': 1, 'description': 1, 'segments': 1, 'skeleton': 1, f'translation.{target_lang}': 1}
+
+    ops, vendor_ids, now = [], set(), datetime.utcnow()
+    for product in products_collection.find(query, projection).batch_size(batch_size):
+        if fields := patch_translation(product, entry, previous_target_text):
+            fields[f'translation.{target_lang}.updated_at'] = now
+            ops.append(UpdateOne({'_id': product['_id']}, {'$set': fields}))
+            vendor_ids.add(product['vendor_id'])
+    patched = len(ops)
+    bulk_update(products_collection, ops, batch_size)
+    return vendor_ids, patched
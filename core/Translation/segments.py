@@ -0,0 +1,69 @@
+import html
+import re
+
+
+# markup tokens of a description: comments, doctype/cdata/processing instructions, script and style
+# elements with their content, and tags with quoted attribute values that may contain '>'
+MARKUP_PATTERN = re.compile(
+    r'<!--.*?-->'
+    r'|<[!?][^>]*>'
+    r'|<(script|style)\b[^>]*>.*?</\1\s*>'
+    r'|</?[a-zA-Z][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>',
+    re.DOTALL | re.IGNORECASE
+)
+
+# a character or a character reference of a text
+TOKEN_PATTERN = re.compile(r'&(?:#\d+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);?|.', re.DOTALL)
+
+
+def extract_segments(description):
+    # split a description into its text segments and the skeleton around them:
+    # description == skeleton[0] + segments[0] + skeleton[1] + ... + segments[-1] + skeleton[-1],
+    # with the segments unescaped and stripped, their surrounding whitespace staying in the skeleton
+    segments, skeleton, markup, position = [], [], [], 0
+    for match in MARKUP_PATTERN.finditer(description):
+        add_text(description[position:match.start()], segments, skeleton, markup)
+        markup.append(match.group())
+        position = match.end()
+    add_text(description[position:], segments, skeleton, markup)
+    skeleton.append(''.join(markup))
+    return segments, skeleton
+
+
+def add_text(text, segments, skeleton, markup):
+    start, end = text_offsets(text)
+    if start == end:
+        markup.append(text)
+        return
+    markup.append(text[:start])
+    skeleton.append(''.join(markup))
+    segments.append(html.unescape(text[start:end]))
+    markup[:] = [text[end:]]
+
+
+def text_offsets(text):
+    # offsets of the text between its leading and trailing whitespace, whitespace written as an entity
+    # (&nbsp;, &#32;) included, so it stays in the skeleton
+    if '&' not in text:
+        start = len(text) - len(text.lstrip())
+        return start, max(start, len(text.rstrip()))
+    tokens = [match.span() for match in TOKEN_PATTERN.finditer(text) if html.unescape(match.group()).strip()]
+    if not tokens:
+        return 0, 0
+    return tokens[0][0], tokens[-1][1]
+
+
+def merge_segments(skeleton, translations):
+    # inverse of extract_segments, the translations are escaped back into the skeleton
+    parts = [skeleton[0]]
+    for translation, markup in zip(translations, skeleton[1:]):
+        parts.append(html.escape(translation, quote=False))
+        parts.append(markup)
+    return ''.join(parts)
+
+
+def extract_all(descriptions, executor=None, chunksize=32):
+    # extract the segments of many descriptions, on a process pool when one is given
+    if executor is None:
+        return [extract_segments(description) for description in descriptions]
+    return list(executor.map(extract_segments, descriptions, chunksize=chunksize))
@@ -1,45 +1,66 @@
 from requests_html import HTMLSession
 from fake_useragent import UserAgent
+import os
 import re
 import json
 import time
 from pathlib import Path
-from core.models import Vendor
+from core.db import config
+from core.models import Vendor, stale_languages
 from bs4 import BeautifulSoup
 from core.Translation.bing import BingTranslator
+from core.tasks import snapshot_task
 from concurrent.futures import wait, as_completed
 
 
+# products translated together in batch mode
+WINDOW_SIZE = 200
+
+
 if __name__ == '__main__':
-    key = "d74339cf185c4d42896344bcbfbc61d6"
-    location = "germanywestcentral"
-    translator = BingTranslator(key, location, max_workers=25)
+    key = config['BING_TRANSLATOR_KEY']
+    location = config['BING_TRANSLATOR_LOCATION']
+    translator = BingTranslator(key, location, max_workers=25, process_workers=os.cpu_count())
 
     languages = ['ar', 'en']
-    to_lang = 'ar'
 
     vendors = Vendor.get_all()
     vendors = [vendors[0]]
 
-    for to_lang in languages:
-        for vendor in vendors:
-            total_products = vendor.get_products_count()
-            print('=> Vendor:', vendor, total_products)
-            products = vendor.get_products(limit=50000, not_translated=True, lang=to_lang) #50000
-            # products = [list(products)[1]]
+    for vendor in vendors:
+        total_products = vendor.get_products_count()
+        print('=> Vendor:', vendor, total_products)
+        # products missing any of the languages or translated from an older name or description,
+        # translated to all those languages at once
+        products = vendor.get_products(limit=50000, stale=True, lang=languages, with_segments=True) #50000
+        # products = [list(products)[1]]
+
+        counter = 0
+
+        # windows of products translated together, so the segments they share are translated once
+        windows = [[]]
+        for product in products:
+            if len(windows[-1]) == WINDOW_SIZE:
+                windows.append([])
+            windows[-1].append(product)
 
-            translated_products = []
-            counter = 0
+        # languages each product is missing or has a stale translation of, only those are written back
+        missing = {product['_id']: stale_languages(product, languages) for window in windows for product in window}
 
-            futures = [translator.executor.submit(translator.translate_product, product, to_lang) for product in products]
+        futures = [translator.executor.submit(translator.translate_products, window, languages) for window in windows if window]
 
+        with vendor.bulk_add_product_translations() as writer:
+            for future in as_completed(futures):
+                for product in future.result():
+                    counter += 1
+                    writer.add(product['_id'], {lang: product['translation'][lang] for lang in missing[product['_id']]})
+                stats = translator.stats_info()
+                print(f'=> Products [{counter}/{total_products}] - {languages} - segments {stats["segments"]} - '
+                      f'unique {stats["unique_segments"]} - dedup {stats["dedup_ratio"]:.1%} - api calls {stats["api_calls"]}')
 
-            for i, future in enumerate(as_completed(futures), 1):
-                counter += 1
-                print(f'=> Products [{counter}/{total_products}] - {to_lang}')
-                product = future.result()
-                # print(product['translation']['description'])
-                vendor.add_product_translation(product['_id'], to_lang, product['translation'])
-                print(product['_id'])
+        print(f'=> {writer.written} products written - {len(writer.failed)} failed')
 
+        print('=> TM cache:', translator.TM.cache_info())
 
+        # refresh the translated feed snapshots
+        snapshot_task.delay(vendor.name, languages)
@@ -0,0 +1,110 @@
+import sys
+from datetime import datetime
+from pymongo import UpdateOne, DeleteMany
+from core.db import db, products_collection, translation_key, search_ngrams
+from core.models import render_features_html, source_hash
+from core.Translation.segments import extract_segments
+
+
+def bulk_update(collection, ops, batch_size=1000):
+    # write the update operations in unordered batches
+    batch, total = [], 0
+    for op in ops:
+        batch.append(op)
+        if len(batch) == batch_size:
+            total += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        total += collection.bulk_write(batch, ordered=False).modified_count
+    return total
+
+
+def backfill_features_html():
+    print('=> Backfilling products features_html..')
+    products = products_collection.find({'features_html': {'$exists': False}}, {'variant_features': 1})
+    ops = (UpdateOne({'_id': p['_id']}, {'$set': {'features_html': render_features_html(p.get('variant_features'))}})
+           for p in products.batch_size(1000))
+    print(f'=> {bulk_update(products_collection, ops)} products updated')
+
+
+def backfill_product_timestamps():
+    print('=> Backfilling products created_at/updated_at..')
+    # products written before the timestamps existed get their _id creation time
+    result = products_collection.update_many({'updated_at': {'$exists': False}}, [
+        {'$set': {'created_at': {'$toDate': '$_id'}, 'updated_at': {'$toDate': '$_id'}}}
+    ])
+    print(f'=> {result.modified_count} products updated')
+
+
+def backfill_source_hashes():
+    print('=> Backfilling products source_hash..')
+    # translations written before the hash existed have none, so the stale selector picks them up once
+    products = products_collection.find({'source_hash': {'$exists': False}}, {'name': 1, 'description': 1})
+    ops = (UpdateOne({'_id': p['_id']}, {'$set': {'source_hash': source_hash(p)}}) for p in products.batch_size(1000))
+    print(f'=> {bulk_update(products_collection, ops)} products updated')
+
+
+def backfill_segments():
+    print('=> Backfilling products segments..')
+    products = products_collection.find({'segments': {'$exists': False}}, {'description': 1})
+    ops = (UpdateOne({'_id': p['_id']}, {'$set': dict(zip(('segments', 'skeleton'), extract_segments(p.get('description') or '')))})
+           for p in products.batch_size(1000))
+    print(f'=> {bulk_update(products_collection, ops)} products updated')
+
+
+def backfill_translation_keys():
+    print('=> Backfilling translation memory keys..')
+    collection = db['translation_memory']
+    entries = collection.find({'key': {'$exists': False}}, {'source_text': 1, 'source_lang': 1, 'target_lang': 1})
+    ops = (UpdateOne({'_id': e['_id']}, {'$set': {'key': translation_key(e['source_text'], e['source_lang'], e.get('target_lang'))}})
+           for e in entries.batch_size(1000))
+    updated = bulk_update(collection, ops)
+    print(f'=> {updated} entries updated')
+    if not updated:
+        return
+
+    # texts differing only by whitespace or unicode normalization now share a key,
+    # keep the last edited entry (or the oldest one) of each key
+    duplicates = collection.aggregate([
+        {'$sort': {'last_update': -1, '_id': 1}},
+        {'$group': {'_id': '$key', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+    ops = [DeleteMany({'_id': {'$in': d['ids'][1:]}}) for d in duplicates]
+    deleted = collection.bulk_write(ops, ordered=False).deleted_count if ops else 0
+    print(f'=> {deleted} duplicate entries deleted')
+
+
+def backfill_search_ngrams():
+    print('=> Backfilling translation memory search_ngrams..')
+    collection = db['translation_memory']
+    entries = collection.find({'search_ngrams': {'$exists': False}}, {'source_text': 1, 'target_text': 1})
+    ops = (UpdateOne({'_id': e['_id']}, {'$set': {'search_ngrams': search_ngrams(e.get('source_text'), e.get('target_text'))}})
+           for e in entries.batch_size(1000))
+    print(f'=> {bulk_update(collection, ops)} entries updated')
+
+
+BACKFILLS = {
+    'features_html': backfill_features_html,
+    'timestamps': backfill_product_timestamps,
+    'source_hashes': backfill_source_hashes,
+    'segments': backfill_segments,
+    'translation_keys': backfill_translation_keys,
+    'search_ngrams': backfill_search_ngrams,
+}
+
+
+def run_backfills(names, force=False):
+    # the backfills done are recorded, so the ones run at every start only scan the collections once
+    migrations = db['migrations']
+    for name in names:
+        if not force and migrations.find_one({'_id': f'backfill_{name}'}):
+            continue
+        BACKFILLS[name]()
+        migrations.update_one({'_id': f'backfill_{name}'}, {'$set': {'done_at': datetime.utcnow()}}, upsert=True)
+
+
+if __name__ == '__main__':
+    # usage: python -m core.backfill [--force] [name ...], runs every backfill not done yet when no name is given
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+    run_backfills(args or BACKFILLS, force='--force' in sys.argv[1:])
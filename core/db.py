@@ -2,8 +2,13 @@ import pymongo.errors
 from pymongo import MongoClient, ASCENDING, DESCENDING, errors
 from bson import ObjectId
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import hashlib
 import os
 import pprint
+import unicodedata
 
 
 load_dotenv()
@@ -15,6 +20,40 @@ vendors_collection = db['vendors']
 products_collection = db['products']
 product_urls_collection = db['product_urls']
 
+# languages the catalog is translated to
+translation_languages = config.get('TRANSLATION_LANGUAGES', 'ar,en').split(',')
+
+# bounded thread pool running the blocking pymongo calls of the async endpoints,
+# so a slow query holds one of its threads instead of the event loop
+db_executor = ThreadPoolExecutor(max_workers=int(config.get('DB_THREADS', 20)), thread_name_prefix='db')
+
+
+def translation_key(source_text, source_lang, target_lang):
+    # fixed width key of a TM entry: digest of the normalized source text and the language pair
+    text = unicodedata.normalize('NFC', source_text.strip())
+    return hashlib.sha1(f'{source_lang}\x00{target_lang}\x00{text}'.encode('utf-8')).digest()
+
+
+def search_ngrams(*texts):
+    # distinct lower cased trigrams of the texts, the multikey index of the TM search
+    grams = set()
+    for text in texts:
+        text = unicodedata.normalize('NFC', (text or '').lower())
+        grams.update(text[i:i + 3] for i in range(len(text) - 2))
+    return sorted(grams)
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+
+async def iterate_db(iterator):
+    # consume a blocking iterator (a cursor, or a generator reading one) on the db pool
+    sentinel = object()
+    while (item := await run_db(next, iterator, sentinel)) is not sentinel:
+        yield item
+
 
 def migrate_vendor_collection():
     print('=> Migrating vendors..')
@@ -94,6 +133,33 @@ def migrate_product_collection():
                 'variant_features': {
                     'bsonType': 'array'
                 },
+                'features_html': {
+                    'bsonType': 'string',
+                },
+                'content_hash': {
+                    'bsonType': 'string',
+                },
+                'source_hash': {
+                    'bsonType': 'string',
+                },
+                'segments': {
+                    'bsonType': 'array',
+                    'items': {
+                        'bsonType': 'string'
+                    }
+                },
+                'skeleton': {
+                    'bsonType': 'array',
+                    'items': {
+                        'bsonType': 'string'
+                    }
+                },
+                'created_at': {
+                    'bsonType': 'date',
+                },
+                'updated_at': {
+                    'bsonType': 'date',
+                },
                 'url': {
                     'bsonType': 'string',
                 },
@@ -110,6 +176,21 @@ def migrate_product_collection():
     db.command('collMod', 'products', validator=product_validator)
     # index creation
     products_collection.create_index([('vendor_id', ASCENDING)])
+    products_collection.create_index([('vendor_id', ASCENDING), ('_id', ASCENDING)])
+    products_collection.create_index([('vendor_id', ASCENDING), ('updated_at', ASCENDING)])
+    # translated exports only scan the products translated to their language, delta ones on the
+    # updated_at of the translation
+    for lang in translation_languages:
+        products_collection.create_index(
+            [('vendor_id', ASCENDING), ('_id', ASCENDING)],
+            name=f'vendor_id_translated_{lang}',
+            partialFilterExpression={f'translation.{lang}': {'$exists': True}}
+        )
+        products_collection.create_index(
+            [('vendor_id', ASCENDING), (f'translation.{lang}.updated_at', ASCENDING)],
+            name=f'vendor_id_translation_{lang}_updated_at',
+            partialFilterExpression={f'translation.{lang}': {'$exists': True}}
+        )
     products_collection.create_index([('vendor_id', ASCENDING), ('code', ASCENDING)], unique=True)
 
 
@@ -152,12 +233,26 @@ def migrate_translation_memory_collection():
         '$jsonSchema': {
             'bsonType': 'object',
             'required': ['source_text', 'source_lang'],
+            'properties': {
+                'key': {
+                    'bsonType': 'binData',
+                },
+                'search_ngrams': {
+                    'bsonType': 'array',
+                },
+            }
         }
     }
     # apply schema
     db.command('collMod', 'translation_memory', validator=trans_memory_validator)
-    # index creation
-    trans_memory_collection.create_index([('source_text', ASCENDING), ('source_lang', ASCENDING), ('target_lang', ASCENDING)], unique=True)
+    # index creation, lookups go through the key instead of the full source text;
+    # entries written before the key existed get one from start.sh before the workers build the unique index
+    trans_memory_collection.create_index([('key', ASCENDING)], unique=True)
+    trans_memory_collection.create_index([('search_ngrams', ASCENDING), ('_id', ASCENDING)])
+    try:
+        trans_memory_collection.drop_index('source_text_1_source_lang_1_target_lang_1')
+    except errors.OperationFailure:
+        pass
 
 
 def migrate_all_collections():
@@ -0,0 +1,116 @@
+import gzip
+import os
+import zlib
+from jinja2 import Environment, FileSystemLoader
+from core.db import translation_languages
+from core.models import Vendor
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, exports fall back to gzip
+    zstandard = None
+
+
+# Create a Jinja2 Environment object
+env = Environment(loader=FileSystemLoader('templates'))
+
+# size of the byte chunks sent to the client while streaming a feed
+CHUNK_SIZE = 64 * 1024
+
+# directory of the pre-rendered gzip feeds, shared by the app and the celery workers
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+
+
+def stream_template(template, chunk_size=CHUNK_SIZE, **context):
+    # render the template lazily and yield utf-8 encoded chunks of at least chunk_size bytes,
+    # so only the current chunk and the current cursor batch are held in memory
+    buffer, size = [], 0
+    for part in template.generate(**context):
+        data = part.encode('utf-8')
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def negotiate_encoding(accept_encoding, supported=None):
+    # pick zstd or gzip (or one of supported) from an Accept-Encoding header by q-value, preferring zstd on ties
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.lower()] = q
+    supported = supported or (['zstd', 'gzip'] if zstandard else ['gzip'])
+    q, _, encoding = max((weights.get(name, weights.get('*', 0.0)), -i, name) for i, name in enumerate(supported))
+    return encoding if q > 0 else None
+
+
+def compress_stream(chunks, encoding):
+    # compress the chunks incrementally, flushing a complete block after each one,
+    # so the client can decode the feed while it is still being rendered
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        flush_block = zlib.Z_SYNC_FLUSH
+    for chunk in chunks:
+        if data := compressor.compress(chunk) + compressor.flush(flush_block):
+            yield data
+    yield compressor.flush()
+
+
+def snapshot_path(vendor_name, lang=None):
+    filename = f'{vendor_name}_{lang}.xml.gz' if lang else f'{vendor_name}.xml.gz'
+    return os.path.join(SNAPSHOT_DIR, filename)
+
+
+def write_snapshot(path, chunks):
+    # write to a temporary file first, so requests never see a half written snapshot
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with gzip.open(temp_path, 'wb', compresslevel=6) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def build_snapshot(vendor, stock=1):
+    print(f'=> [{vendor}] Building feed snapshot...')
+    template = env.get_template(f'{vendor.name}.xml')
+    products = vendor.get_products(limit=-1)
+    write_snapshot(snapshot_path(vendor.name), stream_template(template, products=products, vendor=vendor, stock=stock))
+
+
+def build_translated_snapshot(vendor, lang):
+    print(f'=> [{vendor}] Building {lang} feed snapshot...')
+    template = env.get_template(f'{vendor.name}_translated.xml')
+    products = vendor.get_translated_products(lang, limit=-1)
+    write_snapshot(snapshot_path(vendor.name, lang), stream_template(template, products=products, lang=lang))
+
+
+def build_snapshots(vendor_name, langs=None):
+    # without langs, rebuild the vendor feed and all its translated feeds
+    vendor = Vendor.find_by_name(vendor_name)
+    if not vendor:
+        raise ValueError(f"Unsupported vendor '{vendor_name}'")
+    if langs is None:
+        build_snapshot(vendor)
+        langs = translation_languages
+    for lang in langs:
+        build_translated_snapshot(vendor, lang)
@@ -1,14 +1,59 @@
 import pprint
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime
 from bson import ObjectId
-from pymongo import errors
+from pymongo import errors, UpdateOne
+from core.Translation.segments import extract_segments
 from core.db import (
-    db,
+    config,
     vendors_collection,
     products_collection,
     product_urls_collection,
 )
 
 
+def render_features_html(variant_features):
+    # one <Feature_Key><![CDATA[value]]></Feature_Key> element per variant feature
+    html = ''
+    for feature in variant_features or []:
+        key = feature['key'].replace(' ', '_')
+        value = feature['value']
+        if isinstance(value, bool):
+            value = str(value).lower()
+        html += f'<{key}><![CDATA[{"" if value is None else value}]]></{key}>'
+    return html
+
+
+def content_hash(product):
+    # digest of the scraped fields, used to tell a re-scraped product apart from an unchanged one
+    fields = {key: value for key, value in product.items()
+              if key not in ('_id', 'vendor_id', 'created_at', 'updated_at', 'content_hash', 'source_hash',
+                             'segments', 'skeleton')}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def source_hash(product):
+    # digest of the translated source fields, stored on the product and on each of its translations
+    return hashlib.sha1(json.dumps([product.get('name'), product.get('description')]).encode('utf-8')).hexdigest()
+
+
+def stale_languages(product, langs):
+    # languages the product is not translated to, or was translated to from another name or description
+    translation = product.get('translation', {})
+    return [lang for lang in langs
+            if lang not in translation or translation[lang].get('source_hash') != product.get('source_hash')]
+
+
+def translation_fields(translations):
+    # translation.<lang> fields of {lang: translation}, each stamped with its own updated_at
+    # so translating a product does not move it in the source language delta export
+    now = datetime.utcnow()
+    return {f'translation.{lang}': dict(translation, updated_at=now) for lang, translation in translations.items()}
+
+
 class Vendor:
     def __init__(self, name, nickname='', category='', language='tr', id=''):
         self.name = name.lower()
@@ -31,119 +76,121 @@ class Vendor:
             query['status'] = status
         return product_urls_collection.count_documents(query)
 
-    def get_products(self, offset=0, limit=1000, not_translated=False, lang=None):
-        if limit == -1:
-            limit = self.get_products_count()
-
-        query = [
-            {
-                '$match': {
-                    'vendor_id': self.id
-                }
-            },
-            {
-                '$lookup': {
-                    'from': 'vendors',
-                    'localField': 'vendor_id',
-                    'foreignField': '_id',
-                    'as': 'vendor'
-                }
-            },
-            {
-                '$unwind': {
-                    'path': '$vendor',
-                    'preserveNullAndEmptyArrays': True
-                }
-            },
-            {
-                '$project': {
-                    'vendor_id': 0,
-                }
-            },
-            {
-                '$addFields': {
-                    'features_html': {
-                        '$reduce': {
-                            'input': '$variant_features',
-                            'initialValue': '',
-                            'in': {
-                                '$concat': [
-                                    '$$value',
-                                    '<',
-                                    {'$replaceAll': {'input': '$$this.key', 'find': ' ', 'replacement': '_'}},
-                                    '><![CDATA[',
-                                    {'$toString': '$$this.value'},
-                                    ']]></',
-                                    {'$replaceAll': {'input': '$$this.key', 'find': ' ', 'replacement': '_'}},
-                                    '>',
-                                ]
-                            }
-                        }
-                    }
-                }
-            }
-        ]
-
-        if not_translated:
-            query.append({
-                '$match': {
-                    f'translation.{lang}': {'$exists': False}
-                }
-            })
+    def get_products_match(self, not_translated=False, lang=None, after=None, since=None, stale=False):
+        match = {'vendor_id': self.id}
+        if stale:
+            # not translated, or translated from another name or description
+            langs = lang if isinstance(lang, list) else [lang]
+            stale_match = [{'$ne': [f'$translation.{l}.source_hash', '$source_hash']} for l in langs]
+            match['$expr'] = {'$or': stale_match}
+        if not_translated and isinstance(lang, list):
+            # missing any of the languages
+            match['$or'] = [{f'translation.{l}': {'$exists': False}} for l in lang]
+        elif not_translated:
+            match[f'translation.{lang}'] = {'$exists': False}
+        # keyset pagination: seek past the last exported product on the (vendor_id, _id) index
+        if after:
+            match['_id'] = {'$gt': ObjectId(after)}
+        # delta export: only the products changed since then, on the (vendor_id, updated_at) index
+        if since:
+            match['updated_at'] = {'$gte': since}
+        return match
+
+    def get_products(self, offset=0, limit=1000, not_translated=False, lang=None, after=None, since=None,
+                     batch_size=1000, stale=False, with_segments=False):
+        # features_html is stored at ingest time, so the export is a plain indexed find;
+        # the vendor fields are rendered from this Vendor instance, not joined on every product
+        match = self.get_products_match(not_translated, lang, after, since, stale)
+        projection = {'vendor_id': 0} if with_segments else {'vendor_id': 0, 'segments': 0, 'skeleton': 0}
+        products = products_collection.find(match, projection).sort('_id', 1).skip(offset).batch_size(batch_size)
+
+        # limit -1 streams all the vendor products
+        if limit != -1:
+            products = products.limit(limit)
+        return products
 
-        query.append({'$skip': offset})
-        query.append({'$limit': limit})
+    def get_products_by_ids(self, product_ids, batch_size=1000):
+        object_ids = [ObjectId(product_id) for product_id in product_ids]
+        return products_collection.find({'vendor_id': self.id, '_id': {'$in': object_ids}}, {'vendor_id': 0}).batch_size(batch_size)
 
-        products = products_collection.aggregate(query)
-        return products
+    def get_products_next_cursor(self, offset=0, limit=1000, not_translated=False, lang=None, after=None, since=None):
+        match = self.get_products_match(not_translated, lang, after, since)
+        return self.get_next_cursor(match, offset, limit)
 
-    def get_translated_products(self, lang, offset=0, limit=1000):
-        query = [
-            {
-                '$match': {
-                    'vendor_id': self.id,
-                    'translation': {'$exists': True},
-                    f'translation.{lang}': {'$exists': True}
-                }
-            },
-            {
-                '$project': {
-                    '_id': 1,
-                    'code': 1,
-                    'name': 1,
-                    'description': 1,
-                    'translation': 1,
-                }
-            },
-            {
-                '$skip': offset
-             }
-        ]
-
-        if limit:
-            query.append({'$limit': limit})
-
-        products = products_collection.aggregate(query)
+    def get_translated_products_match(self, lang, after=None, since=None):
+        # matches the partial (vendor_id, _id) index of the language
+        match = {
+            'vendor_id': self.id,
+            f'translation.{lang}': {'$exists': True}
+        }
+        if after:
+            match['_id'] = {'$gt': ObjectId(after)}
+        # translations carry their own updated_at, the product one only moves with the scraped content
+        if since:
+            match[f'translation.{lang}.updated_at'] = {'$gte': since}
+        return match
+
+    def get_translated_products(self, lang, offset=0, limit=1000, after=None, since=None, batch_size=1000):
+        # only read the fields the translated templates render
+        projection = {
+            '_id': 1,
+            'code': 1,
+            'name': 1,
+            f'translation.{lang}.name': 1,
+            f'translation.{lang}.description': 1,
+        }
+        match = self.get_translated_products_match(lang, after, since)
+        products = products_collection.find(match, projection).sort('_id', 1).skip(offset).batch_size(batch_size)
+
+        if limit and limit != -1:
+            products = products.limit(limit)
         return products
 
+    def get_translated_products_next_cursor(self, lang, offset=0, limit=1000, after=None, since=None):
+        match = self.get_translated_products_match(lang, after, since)
+        return self.get_next_cursor(match, offset, limit)
+
+    @staticmethod
+    def get_next_cursor(match, offset, limit):
+        # the cursor is the _id of the last product of the page, or None on the last page
+        if not limit or limit == -1:
+            return None
+        docs = list(products_collection.find(match, {'_id': 1}).sort('_id', 1).skip(offset + limit - 1).limit(2))
+        return str(docs[0]['_id']) if len(docs) == 2 else None
+
     def get_products_count(self):
         return products_collection.count_documents({'vendor_id': self.id})
 
     def bulk_create_products(self, products):
         # print('=> Inserting products...')
-        docs = products.copy()
-        for d in docs:
-            d['vendor_id'] = self.id
+        # upsert on (vendor_id, code), updated_at only moves when the scraped content changed
+        now = datetime.utcnow()
+        ops = []
+        for product in products:
+            doc = dict(product, vendor_id=self.id)
+            doc['features_html'] = render_features_html(doc.get('variant_features'))
+            doc['content_hash'] = content_hash(doc)
+            doc['source_hash'] = source_hash(doc)
+            # the translatable text of the description, so translation never parses the html
+            doc['segments'], doc['skeleton'] = extract_segments(doc.get('description') or '')
+            # literal values, so scraped strings starting with '$' are not read as field paths
+            fields = {key: {'$literal': value} for key, value in doc.items() if key != '_id'}
+            fields['created_at'] = {'$ifNull': ['$created_at', now]}
+            fields['updated_at'] = {'$cond': [{'$eq': ['$content_hash', doc['content_hash']]}, '$updated_at', now]}
+            ops.append(UpdateOne({'vendor_id': self.id, 'code': doc['code']}, [{'$set': fields}], upsert=True))
+        if not ops:
+            return
         try:
-            products_collection.insert_many(docs, ordered=False)
+            result = products_collection.bulk_write(ops, ordered=False)
+            inserted, modified, failed = result.upserted_count, result.modified_count, 0
         except errors.BulkWriteError as bwe:
             for error in bwe.details['writeErrors']:
                 if error['code'] != 11000:  # duplicate error
                     print('ERROR:', error)
                     raise bwe
-
-                docs.remove(error['op'])  # remove failed docs
-        print(f'=> {len(products)} documents - {len(docs)} inserted - {len(products) - len(docs)} failed')
+            inserted, modified = bwe.details['nUpserted'], bwe.details['nModified']
+            failed = len(bwe.details['writeErrors'])
+        print(f'=> {len(ops)} documents - {inserted} inserted - {modified} updated - {failed} failed')
 
     def bulk_create_product_urls(self, product_urls):
         # print('=> inserting product urls...')
@@ -169,10 +216,16 @@ class Vendor:
 
     def add_product_translation(self, proudct_id, lang, translation):
         try:
-            products_collection.update_one({'_id': proudct_id}, {'$set': {f'translation.{lang}': translation}})
+            products_collection.update_one({'_id': proudct_id}, {
+                '$set': {f'translation.{lang}': dict(translation, updated_at=datetime.utcnow())}
+            })
         except errors.BulkWriteError as bwe:
             print('ERROR:', bwe)
 
+    def bulk_add_product_translations(self, batch_size=500, flush_interval=5.0):
+        # buffered writer of product translations, use as a context manager so the rest is flushed at the end
+        return ProductTranslationBuffer(batch_size, flush_interval)
+
     def delete_all_products(self):
         # delete all vendor products
         return products_collection.delete_many({'vendor_id': self.id})
@@ -188,6 +241,7 @@ class Vendor:
         else:
             result = vendors_collection.insert_one(vendor_dict)
             self.id = result.inserted_id
+        vendor_registry.add(self)
 
     def to_dict(self):
         vendor_dict = {
@@ -212,13 +266,20 @@ class Vendor:
 
     @classmethod
     def find_by_name(cls, name):
+        vendor = vendor_registry.get_by_name(name)
+        if vendor:
+            return vendor
+        # not cached yet, e.g. created by another process since the last refresh
         vendor_dict = vendors_collection.find_one({'name': name.lower()})
-        return cls.from_dict(vendor_dict) if vendor_dict else None
+        return vendor_registry.add(cls.from_dict(vendor_dict)) if vendor_dict else None
 
     @classmethod
     def find_by_id(cls, id):
+        vendor = vendor_registry.get_by_id(id)
+        if vendor:
+            return vendor
         vendor_dict = vendors_collection.find_one({'_id': ObjectId(id)})
-        return cls.from_dict(vendor_dict) if vendor_dict else None
+        return vendor_registry.add(cls.from_dict(vendor_dict)) if vendor_dict else None
 
     @classmethod
     def get_all(cls):
@@ -229,6 +290,93 @@ class Vendor:
         return self.name
 
 
+class ProductTranslationBuffer:
+    # translation.<lang> updates buffered and written with one unordered bulk_write
+    # every batch_size products or flush_interval seconds, failures are kept per product
+    def __init__(self, batch_size=500, flush_interval=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ops = []
+        self.product_ids = []
+        self.written = 0
+        self.failed = {}
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, product_id, translations):
+        op = UpdateOne({'_id': product_id}, {'$set': translation_fields(translations)})
+        with self.lock:
+            self.ops.append(op)
+            self.product_ids.append(product_id)
+            due = len(self.ops) >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            ops, product_ids = self.ops, self.product_ids
+            self.ops, self.product_ids = [], []
+            self.flushed_at = time.monotonic()
+        if not ops:
+            return
+        try:
+            self.written += products_collection.bulk_write(ops, ordered=False).matched_count
+        except errors.BulkWriteError as bwe:
+            self.written += bwe.details['nMatched']
+            for error in bwe.details['writeErrors']:
+                product_id = product_ids[error['index']]
+                self.failed[product_id] = error['errmsg']
+                print(f'ERROR: product {product_id}:', error['errmsg'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class VendorRegistry:
+    # process local cache of the vendors keyed by name and by _id, reloaded every ttl seconds
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.by_name = {}
+        self.by_id = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        vendors = [Vendor.from_dict(vendor_dict) for vendor_dict in vendors_collection.find()]
+        with self.lock:
+            self.by_name = {vendor.name: vendor for vendor in vendors}
+            self.by_id = {vendor.id: vendor for vendor in vendors}
+            self.loaded_at = time.monotonic()
+
+    def is_expired(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def add(self, vendor):
+        with self.lock:
+            # drop the old name of a renamed vendor
+            if (cached := self.by_id.get(vendor.id)) and cached.name != vendor.name:
+                self.by_name.pop(cached.name, None)
+            self.by_name[vendor.name] = vendor
+            self.by_id[vendor.id] = vendor
+        return vendor
+
+    def get_by_name(self, name):
+        if self.is_expired():
+            self.load()
+        return self.by_name.get(name.lower())
+
+    def get_by_id(self, id):
+        if self.is_expired():
+            self.load()
+        return self.by_id.get(ObjectId(id))
+
+
+vendor_registry = VendorRegistry(ttl=int(config.get('VENDOR_REGISTRY_TTL', 300)))
+
+
 if __name__ == '__main__':
     # vendor_name = 'vivense'
     # vendor = Vendor.find_by_name(vendor_name)
@@ -270,33 +418,6 @@ if __name__ == '__main__':
     # vendor.bulk_update_product_urls_status(urls, 0)
     # vendor.delete_all_products()
 
-
-
-
-
-    translation_memory_collection = db['translation_memory']
-    # Retrieve all translation_memory documents
-    translation_memory_documents = translation_memory_collection.find()
-
-    # Iterate over each translation_memory document
-    for tm_document in translation_memory_documents:
-        source_text = tm_document["source_text"]
-
-        # Search for products that contain the source_text in their name or description
-        product_filter = {
-            "$or": [
-                {"name": {"$regex": source_text, "$options": "i"}},
-                {"description": {"$regex": source_text, "$options": "i"}}
-            ]
-        }
-        matching_products = products_collection.find(product_filter)
-
-        # Get the list of matching product IDs
-        matching_product_ids = [str(product["_id"]) for product in matching_products]
-
-        print('=>', source_text, matching_product_ids)
-        # Update the translation_memory document with the matching product IDs
-        translation_memory_collection.update_one(
-            {"_id": ObjectId(tm_document["_id"])},
-            {"$set": {"products": matching_product_ids}}
-        )
+    # link the TM entries to the products using them, see core/Translation/linker.py
+    from core.Translation.linker import link_products
+    link_products()
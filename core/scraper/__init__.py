@@ -4,17 +4,18 @@ from core.scraper.koctas import KoctasScraper
 
 
 class ScraperFactory:
+    # Add more scraper classes here as needed
+    SCRAPERS = {
+        'vivense': VivenseScraper,
+        'koctas': KoctasScraper,
+    }
+
     @staticmethod
     def get_vendor_scraper_by_name(vendor_name: str):
-        if vendor_name.lower() == "vivense":
-            return VivenseScraper
-
-        if vendor_name.lower() == "koctas":
-            return KoctasScraper
-
-        # Add more scraper classes here as needed
-        else:
+        scraper = ScraperFactory.SCRAPERS.get(vendor_name.lower())
+        if not scraper:
             raise ValueError(f"Unsupported vendor '{vendor_name}'")
+        return scraper
 
 
 
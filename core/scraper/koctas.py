@@ -97,7 +97,8 @@ class KoctasScraper:
                                     i['selected']['variantOptionQualifiers']]
         data['variant_group'] = data['variant_features'] and variant_group or ''
         data['description'] = p['description'] or p['summary']
-        data['images'] = list(set([i['url'] for i in p['images'] if i['format'] == 'zoom']))
+        # deduplicated in the vendor order, a set would reorder them on every run and change the content hash
+        data['images'] = list(dict.fromkeys(i['url'] for i in p['images'] if i['format'] == 'zoom'))
         return data
 
     def get_and_parse_product_details_by_code(self, code, variant_group):
@@ -1,6 +1,11 @@
 from dotenv import load_dotenv
-from celery import Celery
+from celery import Celery, chord
 from core.scraper import ScraperFactory
+from core.export import build_snapshots
+from core.db import products_collection, translation_languages
+from core.models import Vendor, stale_languages
+from core.Translation.bing import BingTranslator
+from core.Translation.propagation import propagate_translation
 import os
 
 
@@ -8,10 +13,127 @@ load_dotenv()
 config = os.environ
 app = Celery('derzan', broker=config['CELERY_BROKER'], backend=config['CELERY_BACKEND'])
 
+# product ids per translation chunk task, and products translated together inside a chunk
+TRANSLATION_CHUNK_SIZE = int(config.get('TRANSLATION_CHUNK_SIZE', 500))
+TRANSLATION_WINDOW_SIZE = int(config.get('TRANSLATION_WINDOW_SIZE', 100))
+
+# one translator per worker process, its http pool and TM cache are reused across the tasks
+translator = None
+
+
+def get_translator():
+    global translator
+    if translator is None:
+        translator = BingTranslator(config['BING_TRANSLATOR_KEY'], config['BING_TRANSLATOR_LOCATION'])
+    return translator
+
 
 @app.task(name='Scraping Task')
 def scraping_task(vendor_name, host, flush, proxy, workers):
     print(f'=> [{vendor_name}] Scraping Task Started...')
     scraper = ScraperFactory.get_vendor_scraper_by_name(vendor_name)
     scraper(host=host, max_workers=workers, proxy=proxy).run(flush)
-    print(f'=> [{vendor_name}] Scraping Task Finished.')
\ No newline at end of file
+    print(f'=> [{vendor_name}] Scraping Task Finished.')
+    snapshot_task.delay(vendor_name)
+
+
+@app.task(name='Snapshot Task')
+def snapshot_task(vendor_name, langs=None):
+    print(f'=> [{vendor_name}] Snapshot Task Started...')
+    build_snapshots(vendor_name, langs)
+    print(f'=> [{vendor_name}] Snapshot Task Finished.')
+
+
+@app.task(name='Translation Task', bind=True)
+def translation_task(self, vendor_name, langs=None, chunk_size=TRANSLATION_CHUNK_SIZE, stale=False):
+    print(f'=> [{vendor_name}] Translation Task Started...')
+    vendor = Vendor.find_by_name(vendor_name)
+    if not vendor:
+        raise ValueError(f"Unsupported vendor '{vendor_name}'")
+    langs = langs or translation_languages
+
+    # the ids of the products missing any of the languages (or with a stale translation),
+    # fanned out in chunks over the workers
+    match = vendor.get_products_match(not_translated=not stale, lang=langs, stale=stale)
+    product_ids = [str(product['_id']) for product in products_collection.find(match, {'_id': 1}).sort('_id', 1)]
+    chunks = [product_ids[i:i + chunk_size] for i in range(0, len(product_ids), chunk_size)]
+    self.update_state(state='PROGRESS', meta={'total': len(product_ids), 'chunks': len(chunks)})
+    if not chunks:
+        print(f'=> [{vendor_name}] Nothing to translate.')
+        return {'vendor': vendor_name, 'langs': langs, 'total': 0, 'chunks': 0}
+
+    # the snapshots are rebuilt even when a chunk fails, by the error callback of the chord
+    callback = translation_done_task.s(vendor_name, langs, task_id=self.request.id)
+    callback.on_error(translation_error_task.s(vendor_name, langs))
+    result = chord(translation_chunk_task.s(vendor_name, chunk, langs) for chunk in chunks)(callback)
+    print(f'=> [{vendor_name}] {len(product_ids)} products in {len(chunks)} chunks')
+    return {'vendor': vendor_name, 'langs': langs, 'total': len(product_ids), 'chunks': len(chunks),
+            'callback_id': result.id}
+
+
+@app.task(name='Translation Chunk Task', bind=True)
+def translation_chunk_task(self, vendor_name, product_ids, langs):
+    vendor = Vendor.find_by_name(vendor_name)
+    translator = get_translator()
+    start = translator.stats_info()
+    progress = {'processed': 0, 'total': len(product_ids), 'api_calls': 0, 'tm_hits': 0, 'failed': 0, 'errors': 0}
+
+    with vendor.bulk_add_product_translations() as writer:
+        window = []
+        for product in vendor.get_products_by_ids(product_ids):
+            window.append(product)
+            if len(window) == TRANSLATION_WINDOW_SIZE:
+                translate_window(translator, writer, window, langs, progress, start)
+                self.update_state(state='PROGRESS', meta=progress)
+                window = []
+        if window:
+            translate_window(translator, writer, window, langs, progress, start)
+    progress['failed'] = progress['errors'] + len(writer.failed)
+    return progress
+
+
+def translate_window(translator, writer, products, langs, progress, start):
+    # languages each product is missing or has a stale translation of, only those are written back
+    # a failed window (e.g. a translator quota error) is counted and skipped, the next stale run retries it
+    missing = {product['_id']: stale_languages(product, langs) for product in products}
+    try:
+        for product in translator.translate_products(products, langs):
+            writer.add(product['_id'], {lang: product['translation'][lang] for lang in missing[product['_id']]})
+    except Exception as e:
+        print(f'=> Failed to translate {len(products)} products:', e)
+        progress['errors'] += len(products)
+    stats = translator.stats_info()
+    progress['processed'] += len(products)
+    progress['api_calls'] = stats['api_calls'] - start['api_calls']
+    progress['tm_hits'] = stats['tm_hits'] - start['tm_hits']
+    progress['failed'] = progress['errors'] + len(writer.failed)
+
+
+@app.task(name='Translation Done Task')
+def translation_done_task(results, vendor_name, langs, task_id=None):
+    totals = {name: sum(result[name] for result in results) for name in ('processed', 'total', 'api_calls', 'tm_hits', 'failed')}
+    print(f'=> [{vendor_name}] Translation Task Finished.', totals)
+    snapshot_task.delay(vendor_name, langs)
+    totals = dict(totals, vendor=vendor_name, langs=langs)
+    # the summed totals also become the result of the translation task the client polls
+    if task_id:
+        app.backend.store_result(task_id, totals, 'SUCCESS')
+    return totals
+
+
+@app.task(name='Translation Error Task')
+def translation_error_task(request, exc, traceback, vendor_name, langs):
+    # a chunk failed so the chord body never runs, the products translated so far are still published
+    print(f'=> [{vendor_name}] Translation Task Failed:', exc)
+    snapshot_task.delay(vendor_name, langs)
+
+
+@app.task(name='Propagation Task')
+def propagation_task(translation_id, previous_target_text, lang):
+    print(f'=> [{translation_id}] Propagation Task Started...')
+    vendor_ids, patched = propagate_translation(translation_id, previous_target_text)
+    print(f'=> [{translation_id}] Propagation Task Finished. {patched} products patched')
+    for vendor_id in vendor_ids:
+        if vendor := Vendor.find_by_id(vendor_id):
+            snapshot_task.delay(vendor.name, [lang])
+    return {'patched': patched}
@@ -3,13 +3,17 @@ from fastapi import FastAPI, Request, HTTPException, Query
 from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
-from core.tasks import scraping_task
-from core.db import migrate_all_collections, db
+from core.tasks import scraping_task, translation_task, propagation_task
+from core.db import migrate_all_collections, db, run_db, iterate_db, products_collection, translation_key, translation_languages, search_ngrams
 from core.scraper import ScraperFactory
-from core.models import Vendor
-from jinja2 import Template, Environment, FileSystemLoader
-import os, io, json
+from core.models import Vendor, vendor_registry
+from core.Translation.TM import TM, LRUCache
+from core.Translation.propagation import propagation_query
+from core.export import env, stream_template, snapshot_path, negotiate_encoding, compress_stream
+import os, re, gzip, json
+from email.utils import formatdate, parsedate_to_datetime
 from typing import Optional, List
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional
@@ -24,12 +28,12 @@ from fastapi.staticfiles import StaticFiles
 load_dotenv()
 config = os.environ
 
-# Create a Jinja2 Environment object
-env = Environment(loader=FileSystemLoader('templates'))
-
 # Migrate db collections
 migrate_all_collections()
 
+# Load the vendors once, the export endpoints resolve them from memory
+vendor_registry.load()
+
 app = FastAPI()
 
 app.mount("/web/static", StaticFiles(directory="web/static"), name="static")
@@ -66,46 +70,178 @@ async def scrape(request: Request, vendor_name: str, workers: int = 1, flush: bo
         return {'error': str(e)}
 
 
+@app.get('/{vendor_name}/translate')
+async def translate(vendor_name: str, lang: Optional[str] = None, chunk_size: int = 500, stale: bool = 0):
+    # lang is one language or a comma separated list, all the translation languages by default;
+    # stale also re-translates the products whose name or description changed since their translation
+    if chunk_size < 1:
+        return {'error': f"Invalid chunk_size: {chunk_size}"}
+    langs = lang.split(',') if lang else translation_languages
+    if unsupported := [l for l in langs if l not in translation_languages]:
+        return {'error': f"Unsupported language '{unsupported[0]}'"}
+    vendor = await run_db(Vendor.find_by_name, vendor_name)
+    if not vendor:
+        return {'error': f"Unsupported vendor '{vendor_name}'"}
+    result = translation_task.delay(vendor.name, langs=langs, chunk_size=chunk_size, stale=stale)
+    return {'vendor': vendor.name, 'langs': langs, 'task_id': result.id}
+
+
+async def xml_response(request, template, filename, stream=True, **context):
+    # set the response headers to indicate a file download
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+    # render the template chunk by chunk while the products cursor is consumed
+    chunks = stream_template(template, **context)
+    # compress the chunks as they are rendered, with the encoding the client accepts
+    if encoding := negotiate_encoding(request.headers.get('accept-encoding', '')):
+        headers['Content-Encoding'] = encoding
+        chunks = compress_stream(chunks, encoding)
+    if stream:
+        return StreamingResponse(iterate_db(chunks), media_type='application/xml; charset=utf-8', headers=headers)
+    content = await run_db(b''.join, chunks)
+    return Response(content=content, media_type='application/xml; charset=utf-8', headers=headers)
+
+
+def iter_file(f, start, end, chunk_size=64 * 1024):
+    # yield the bytes start..end (inclusive) of an open file and close it
+    with f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def iter_gunzip(f, chunk_size=64 * 1024):
+    with f, gzip.open(f) as gz:
+        while data := gz.read(chunk_size):
+            yield data
+
+
+def parse_range(header, size):
+    # only a single "bytes=start-end" range is supported, anything else is served in full
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    start, end = match.groups()
+    # a last byte before the first one makes the range invalid, it is ignored (RFC 7233)
+    if start and end and int(end) < int(start):
+        return None
+    if start == '':
+        # suffix range: the last n bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+def is_not_modified(request, etag, mtime):
+    if if_none_match := request.headers.get('if-none-match'):
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if if_modified_since := request.headers.get('if-modified-since'):
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def snapshot_response(request, path, filename):
+    # serve a pre-rendered gzip feed with conditional and range requests support
+    f = open(path, 'rb')
+    stat = os.fstat(f.fileno())
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        'ETag': etag,
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Vary': 'Accept-Encoding',
+    }
+    media_type = 'application/xml; charset=utf-8'
+    # the decompressed variant has its own etag, picked before the conditional check
+    accepts_gzip = negotiate_encoding(request.headers.get('accept-encoding', ''), ['gzip']) == 'gzip'
+    if not accepts_gzip:
+        etag = headers['ETag'] = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}-identity"'
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        f.close()
+        return Response(status_code=304, headers=headers)
+
+    # decompress on the fly for the clients that don't accept gzip
+    if not accepts_gzip:
+        return StreamingResponse(iter_gunzip(f), media_type=media_type, headers=headers)
+
+    headers['Content-Encoding'] = 'gzip'
+    headers['Accept-Ranges'] = 'bytes'
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (not if_range or if_range == etag):
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range:
+            start, end = byte_range
+            # a range starting past the end of the file cannot be satisfied
+            if start > end:
+                f.close()
+                headers['Content-Range'] = f'bytes */{stat.st_size}'
+                return Response(status_code=416, headers=headers)
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            headers['Content-Length'] = str(end - start + 1)
+            return StreamingResponse(iter_file(f, start, end), status_code=206, media_type=media_type, headers=headers)
+
+    headers['Content-Length'] = str(stat.st_size)
+    return StreamingResponse(iter_file(f, 0, stat.st_size - 1), media_type=media_type, headers=headers)
+
+
 @app.get('/{vendor_name}/export')
-async def export(vendor_name: str, offset: int = 0, limit: int = 100, stock=1):
+async def export(request: Request, vendor_name: str, offset: int = 0, limit: int = 100, stock=1,
+                 stream: bool = 1, after: Optional[str] = None, since: Optional[datetime] = None):
     # fetch the products
-    vendor = Vendor.find_by_name(vendor_name.lower())
+    vendor = await run_db(Vendor.find_by_name, vendor_name.lower())
     if not vendor:
         return {'error': f"Unsupported vendor: '{vendor_name}'"}
+    if after and not ObjectId.is_valid(after):
+        return {'error': f"Invalid cursor: '{after}'"}
+    # Serve the full feed from its snapshot when there is one
+    path = snapshot_path(vendor.name)
+    if limit == -1 and not offset and not after and not since and str(stock) == '1' and os.path.exists(path):
+        return snapshot_response(request, path, 'products.xml')
     # Get products
-    products = vendor.get_products(offset, limit)
+    products = vendor.get_products(offset, limit, after=after, since=since)
+    next_cursor = await run_db(vendor.get_products_next_cursor, offset, limit, after=after, since=since)
     # Render a template
     template = env.get_template(f'{vendor_name}.xml')
-    rendered_xml = template.render(products=products, stock=stock)
-    # convert the rendered XML to_lang bytes
-    xml_bytes = rendered_xml.encode('utf-8')
-    # create a byte stream in memory
-    file_like_object = io.BytesIO(xml_bytes)
-    # set the response headers to_lang indicate a file download
-    response = Response(content=file_like_object.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=products.xml"
-    response.headers["Content-Type"] = "application/xml; charset=utf-8"
+    response = await xml_response(request, template, 'products.xml', stream,
+                                  products=products, vendor=vendor, stock=stock)
+    if next_cursor:
+        response.headers['next_cursor'] = next_cursor
     return response
 
+
 @app.get('/{vendor_name}/translated/export')
-async def export_translated(vendor_name: str, lang: str, offset: int = 0, limit: int = 100):
+async def export_translated(request: Request, vendor_name: str, lang: str, offset: int = 0, limit: int = 100,
+                            stream: bool = 1, after: Optional[str] = None, since: Optional[datetime] = None):
     # fetch the products
-    vendor = Vendor.find_by_name(vendor_name.lower())
+    vendor = await run_db(Vendor.find_by_name, vendor_name.lower())
     if not vendor:
         return {'error': f"Unsupported vendor: '{vendor_name}'"}
+    if after and not ObjectId.is_valid(after):
+        return {'error': f"Invalid cursor: '{after}'"}
+    # Serve the full feed from its snapshot when there is one
+    path = snapshot_path(vendor.name, lang)
+    if limit == -1 and not offset and not after and not since and os.path.exists(path):
+        return snapshot_response(request, path, f'products_{vendor_name}_{lang}.xml')
     # Get translated products
-    translated_products = vendor.get_translated_products(lang, offset, limit)
+    translated_products = await run_db(vendor.get_translated_products, lang, offset, limit, after=after, since=since)
+    next_cursor = await run_db(vendor.get_translated_products_next_cursor, lang, offset, limit,
+                               after=after, since=since)
     # Render a template
     template = env.get_template(f'{vendor_name}_translated.xml')
-    rendered_xml = template.render(products=translated_products, lang=lang)
-    # convert the rendered XML to_lang bytes
-    xml_bytes = rendered_xml.encode('utf-8')
-    # create a byte stream in memory
-    file_like_object = io.BytesIO(xml_bytes)
-    # set the response headers to_lang indicate a file download
-    response = Response(content=file_like_object.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename=products_{vendor_name}_{lang}_{offset}_{offset+limit}.xml"
-    response.headers["Content-Type"] = "application/xml; charset=utf-8"
+    filename = f'products_{vendor_name}_{lang}_{offset}_{offset+limit}.xml'
+    response = await xml_response(request, template, filename, stream, products=translated_products, lang=lang)
+    if next_cursor:
+        response.headers['next_cursor'] = next_cursor
     return response
 
 
@@ -136,6 +272,13 @@ class Translation(BaseModel):
 
 
 translation_memory_collection = db["translation_memory"]
+tm = TM()
+
+
+class TranslationProduct(BaseModel):
+    id: str
+    code: Optional[str] = None
+    name: Optional[str] = None
 
 
 class TranslationItem(BaseModel):
@@ -145,6 +288,8 @@ class TranslationItem(BaseModel):
     target_text: str = Field(...)
     target_lang: str = Field(...)
     last_update: Optional[datetime] = None
+    products: Optional[List[TranslationProduct]] = None
+    product_count: Optional[int] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -157,19 +302,50 @@ class TranslationUpdateItem(BaseModel):
     target_text: Optional[str] = Field(None)
 
 
-@app.put('/translations/{translation_id}', response_model=TranslationItem)
+class TranslationUpdateResponse(TranslationItem):
+    queued_products: int = 0
+
+
+@app.put('/translations/{translation_id}', response_model=TranslationUpdateResponse)
 async def update_translation(translation_id: str, translation_item: TranslationUpdateItem):
-    translation_dict = translation_item.dict()
+    translation_dict = translation_item.dict(exclude_none=True)
     translation_dict["last_update"] = datetime.utcnow()
-    translation_res = translation_memory_collection.update_one(
-        {"_id": ObjectId(translation_id)},
-        {"$set": translation_dict}
-    )
-    if translation_res.modified_count == 0:
+    previous_translation = await run_db(translation_memory_collection.find_one, {"_id": ObjectId(translation_id)})
+    if not previous_translation:
         raise HTTPException(status_code=404, detail="Translation not found")
 
-    updated_translation = translation_memory_collection.find_one({"_id": ObjectId(translation_id)})
+    # the TM key follows the source text, the search n-grams both texts
+    source_lang, target_lang = previous_translation['source_lang'], previous_translation.get('target_lang')
+    if translation_item.source_text is not None:
+        translation_dict["key"] = translation_key(translation_item.source_text, source_lang, target_lang)
+    translation_dict["search_ngrams"] = search_ngrams(
+        translation_dict.get('source_text', previous_translation['source_text']),
+        translation_dict.get('target_text', previous_translation.get('target_text'))
+    )
+    try:
+        await run_db(translation_memory_collection.update_one, {"_id": ObjectId(translation_id)}, {"$set": translation_dict})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Translation already exists")
+
+    # drop the edited entry from the TM cache
+    await run_db(tm.invalidate, previous_translation['source_text'], source_lang, target_lang)
+    if translation_item.source_text is not None:
+        await run_db(tm.invalidate, translation_item.source_text, source_lang, target_lang)
+
+    # patch the new target text into the translated products using the entry, in the background;
+    # an edited source text no longer matches the products it was linked to
+    source_changed = translation_dict.get('source_text', previous_translation['source_text']) != previous_translation['source_text']
+    target_changed = translation_dict.get('target_text', previous_translation.get('target_text')) != previous_translation.get('target_text')
+    queued_products = 0
+    if target_changed and not source_changed and previous_translation.get('products'):
+        queued_products = await run_db(products_collection.count_documents, propagation_query(previous_translation))
+    if queued_products:
+        propagation_task.delay(translation_id, previous_translation.get('target_text'), target_lang)
+
+    updated_translation = await run_db(translation_memory_collection.find_one, {"_id": ObjectId(translation_id)},
+                                       {"products": 0, "search_ngrams": 0})
     updated_translation["id"] = str(updated_translation["_id"])
+    updated_translation["queued_products"] = queued_products
     return updated_translation
 
 
@@ -178,6 +354,35 @@ class Pagination(BaseModel):
     items: List[TranslationItem]
     page: int
     per_page: int
+    next_cursor: Optional[str] = None
+    estimated: bool = False
+
+
+# totals of the recent searches, counting on every page and keystroke is the slow part of the TM screen
+TOTAL_LIMIT = 10000
+totals_cache = LRUCache(maxsize=1000, ttl=int(config.get('TM_TOTALS_TTL', 60)))
+
+# products returned with each entry, the UI only needs a few
+PRODUCTS_PER_ITEM = 10
+
+
+def search_match(term, fields):
+    # the trigrams of the term select the candidates on the multikey index, the escaped substring match confirms them
+    regex = {'$regex': re.escape(term), '$options': 'i'}
+    match = {'$or': [{field: regex} for field in fields]} if len(fields) > 1 else {fields[0]: regex}
+    if grams := search_ngrams(term):
+        match = {'$and': [{'search_ngrams': {'$all': grams}}, match]}
+    return match
+
+
+def count_translations(query):
+    # capped and cached, a total past TOTAL_LIMIT is reported as estimated
+    key = json_util.dumps(query)
+    total = totals_cache.get(key)
+    if total is None:
+        total = translation_memory_collection.count_documents(query, limit=TOTAL_LIMIT)
+        totals_cache.set(key, total)
+    return total
 
 
 @app.get('/translations/', response_model=Pagination)
@@ -186,39 +391,32 @@ async def get_translations(page: int = 0, per_page: int = 25,
                            source_lang: Optional[str] = None,
                            target_text: Optional[str] = None,
                            target_lang: Optional[str] = None,
-                           search: Optional[str] = Query(None)):
-    skip = page * per_page
-    translation_query = {"products": {"$exists": True}}
+                           search: Optional[str] = Query(None),
+                           after: Optional[str] = None):
+    if after and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    conditions = [{"products": {"$exists": True}}]
 
     if search:
-        translation_query['$or'] = [
-            {'source_text': {'$regex': search, '$options': 'i'}},
-            {'target_text': {'$regex': search, '$options': 'i'}}
-        ]
+        conditions.append(search_match(search, ['source_text', 'target_text']))
     else:
         if source_text:
-            translation_query['source_text'] = {'$regex': source_text}
+            conditions.append(search_match(source_text, ['source_text']))
         if source_lang:
-            translation_query['source_lang'] = source_lang
+            conditions.append({'source_lang': source_lang})
         if target_text:
-            translation_query['target_text'] = {'$regex': target_text}
+            conditions.append(search_match(target_text, ['target_text']))
         if target_lang:
-            translation_query['target_lang'] = target_lang
+            conditions.append({'target_lang': target_lang})
+    translation_query = {'$and': conditions}
 
-    # Perform the aggregation to include object data of product IDs
+    # keyset pagination on _id, page is only skipped without a cursor
+    page_query = {'$and': conditions + [{'_id': {'$gt': ObjectId(after)}}]} if after else translation_query
     pipeline = [
-        {"$match": translation_query},
-        {"$skip": skip},
-        {"$limit": per_page},
-        {"$lookup": {
-            "from": "products",
-            "localField": "products",
-            "foreignField": "_id",
-            "as": "product_data"
-        }},
-        {"$addFields": {
-            "products": "$product_data"
-        }},
+        {"$match": page_query},
+        {"$sort": {"_id": 1}},
+        {"$skip": 0 if after else page * per_page},
+        {"$limit": per_page + 1},
         {"$project": {
             "_id": 1,
             "source_text": 1,
@@ -226,17 +424,29 @@ async def get_translations(page: int = 0, per_page: int = 25,
             "last_update": 1,
             "target_text": 1,
             "target_lang": 1,
-            "products": 1
+            "product_count": {"$size": "$products"},
+            "products": {"$slice": ["$products", PRODUCTS_PER_ITEM]}
+        }},
+        # only the product fields the TM screen shows
+        {"$lookup": {
+            "from": "products",
+            "localField": "products",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"_id": 1, "code": 1, "name": 1}}],
+            "as": "products"
         }}
     ]
 
-    translations = list(translation_memory_collection.aggregate(pipeline))
+    translations = await run_db(lambda: list(translation_memory_collection.aggregate(pipeline)))
+    next_cursor = str(translations[per_page - 1]['_id']) if len(translations) > per_page else None
+    translations = translations[:per_page]
     for translation in translations:
         translation['id'] = str(translation['_id'])
-        print(translation)
+        translation['products'] = [dict(product, id=str(product['_id'])) for product in translation['products']]
 
-    total = translation_memory_collection.count_documents(translation_query)
-    response = Pagination(total=total, items=translations, page=page, per_page=per_page)
+    total = await run_db(count_translations, translation_query)
+    response = Pagination(total=total, items=translations, page=page, per_page=per_page,
+                          next_cursor=next_cursor, estimated=total >= TOTAL_LIMIT)
     return response
 
 
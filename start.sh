@@ -1,6 +1,11 @@
 #!/bin/bash
 
 # Run database migrations before starting the server
+# the data backfills run once here, not in each of the gunicorn workers importing main:
+# products written before source_hash existed need one, or the stale selector re-translates them on every run
+# translation memory entries written before the key existed need one (duplicates removed) before the unique index
+# and search_ngrams, or the TM search (which requires them) never returns them
+python -m core.backfill source_hashes translation_keys search_ngrams
 
 
 # Start the server using Gunicorn